@@ -0,0 +1,96 @@
+# Compares the bottom-up CKY parser with the top-down agenda parser on the
+# lines of the dev and test scansion sets, checking that both find the same
+# parses and reporting how long each takes, how many chart entries each
+# builds and how many pairs of entries each tries, from the statistics both
+# collect (see CKY.ParseStats).
+
+import time
+
+import odikon.utils as utils
+import odikon.scan as scan
+import odikon.CKY as CKY
+import odikon.Earley as Earley
+
+# number of times to parse every line with each parser; the fastest run is
+# reported
+NUM_REPEATS = 3
+
+PARSERS = [
+    ["CKY", CKY.runFullCustomInit],
+    ["Agenda", Earley.runFullCustomInit]
+]
+
+# ==== load author data
+available = utils.getContent("data/texts/available.json", True)
+bookLookup = {}
+for o in available:
+    for w in o["works"]:
+        t = utils.Text("data/" + w["location"])
+        for book in t.books:
+            if not(book.author in bookLookup):
+                bookLookup[book.author] = {}
+            bookLookup[book.author][book.textName] = book
+
+# ==== benchmark the parsers on the dev and test scansions
+scan_dev = utils.getContent("data/evaluation/scansion_dev.json", True)
+scan_test = utils.getContent("data/evaluation/scansion_test.json", True)
+
+scanSets = [
+    [scan_dev, "Dev"],
+    [scan_test, "Test"]
+]
+
+report = []
+for scanSet in scanSets:
+    myTests = scanSet[0]
+    myName = scanSet[1]
+
+    # segment every line up front, so only parsing is timed
+    inputs = []
+    for test in myTests:
+        book = bookLookup[test["author"]][test["text"]]
+        for line in book.bookLines:
+            if (line["line_number"] == test["line"]):
+                seg, tokens = scan.segmentLine(line)
+                init = scan.getInit(scan.getSpans(seg))
+                inputs.append((tokens, init, test["meter"]))
+                break
+
+    results = []
+    for parserName, parser in PARSERS:
+        bestTime = float("inf")
+        for _ in range(NUM_REPEATS):
+            parses = []
+            stats = CKY.ParseStats()
+            startTime = time.time()
+            for tokens, init, meter in inputs:
+                gram = scan.meterGrammars[meter]
+                parses.append(parser(tokens, init, gram, [scan.SYM.LINE], printPrs=False,
+                                     pareto=True, flagIndex=scan.BEST_PARSE_FLAG, stats=stats))
+            bestTime = min(bestTime, time.time() - startTime)
+        results.append([parserName, bestTime, parses, stats])
+
+    # both parsers should find exactly the same parses in the same order
+    baseParses = results[0][2]
+    mismatches = 0
+    for parses in [r[2] for r in results[1:]]:
+        for i in range(len(inputs)):
+            if not(len(parses[i]) == len(baseParses[i])):
+                mismatches += 1
+                continue
+            for p1, p2 in zip(parses[i], baseParses[i]):
+                if not(scan.getScanString(p1) == scan.getScanString(p2)) or not((p1["vec"] == p2["vec"]).all()):
+                    mismatches += 1
+                    break
+
+    report.append("%s (%d lines):" % (myName, len(inputs)))
+    for parserName, bestTime, parses, stats in results:
+        numParses = sum([len(p) for p in parses])
+        report.append("  %s: %.3fs, %d chart entries built, %d of %d pairs matched, %d parses" %
+                      (parserName, bestTime, stats.entriesCreated, stats.pairsMatched,
+                       stats.pairsTried, numParses))
+    report.append("  Lines where the parsers disagree: %d" % mismatches)
+    report.append("=====")
+
+print("\n".join(report))
+utils.safeWrite("output/benchmarkReport.txt", "\n".join(report))
@@ -272,8 +272,7 @@ for book in books:
         resolvedIambsNoProper = 0
 
         lines = book.bookLines
-        for line in lines:
-            bestParse = odikon.scanLine(line, "IAMBS")
+        for bestParse in odikon.scanLines(lines, "IAMBS"):
             if not(bestParse == None):
                 v = bestParse['vec']
                 totalTrimiters += 1
@@ -1,6 +1,6 @@
 # Implementation of CKY, with automatic conversion of a grammar to CNF and weights included.
-import copy
-import uuid
+import heapq
+import time
 
 import numpy as np
 
@@ -31,84 +31,130 @@ def cnfAddMemory(lex, gram):
 
     return newLex, newGram
 
-# remove unitary productions
-def cnfRemoveUnits(lex, gram, lexMap=None):
-    # build a map from symbols to lexicon entries
-    if (lexMap == None):
-        lexMap = {}
-        for val in lex:
-            for i, prod in enumerate(lex[val]):
-                sym, _, _ = prod
-                if not(sym in lexMap):
-                    lexMap[sym] = []
-                entry = [val, i]
-                lexMap[sym].append(entry)
-
-    foundUnit = False
-    newLex = []
-    newGram = []
-    targetUnit = None
-
-    # iterate through the grammar looking for a unit production
+# raise a ValueError if the unit productions of a grammar form a cycle, since
+# removing them would never end
+def checkUnitCycles(gram):
+    units = {}
     for prod in gram:
-        _, children, _, _ = prod
-        if not(foundUnit) and (len(children) == 1):
-            foundUnit = True
-            targetUnit = prod
-        else:
-            newGram.append(prod)
-
-    # if there are no unit productions, we return the lexicon and grammar
-    if (not(foundUnit)):
-        return lex, gram
-
-    # if there is at least one unit production, we remove the first one we find.
-
-    # given our target unit production A->B, go through the grammar and find
-    # Every production from B->?, add a production from A->?
-    tsym, tchildren, tweight, tmem = targetUnit
-    tchild = tchildren[0]
+        sym, children, _, _ = prod
+        if (len(children) == 1):
+            if not(sym in units):
+                units[sym] = []
+            units[sym].append(children[0])
+
+    # depth first search, where a symbol is on the path while its state is 1
+    # and done once its state is 2
+    state = {}
+    for first in units:
+        if first in state:
+            continue
+        state[first] = 1
+        stack = [(first, iter(units[first]))]
+        while len(stack) > 0:
+            sym, children = stack[-1]
+            child = next(children, None)
+            if child == None:
+                state[sym] = 2
+                stack.pop()
+            elif state.get(child, 0) == 1:
+                raise ValueError("Unit productions form a cycle through %s" % str(child))
+            elif not(child in state):
+                state[child] = 1
+                stack.append((child, iter(units.get(child, []))))
+
+# remove unitary productions. Each unit production A->B is replaced by a copy
+# of every production of B with A as its symbol, including B's own unit
+# productions, which are removed in turn later; the same goes for B's
+# lexicon entries. The grammar is worked through once in order, with new
+# productions added at the end and productions looked up by symbol, which
+# gives the same result, in the same order, as repeatedly removing the first
+# unit production in the grammar. Raises a ValueError if unit productions
+# form a cycle.
+def cnfRemoveUnits(lex, gram):
+    checkUnitCycles(gram)
+
+    # copy the lexicon so it can be added to, and map symbols to their
+    # lexicon entries
+    newLex = {}
+    lexMap = {}
+    for val in lex:
+        newLex[val] = list(lex[val])
+        for i, prod in enumerate(newLex[val]):
+            sym, _, _ = prod
+            if not(sym in lexMap):
+                lexMap[sym] = []
+            lexMap[sym].append([val, i])
+
+    # productions in order, whether each has been removed, and the indices
+    # of the productions of each symbol
+    prods = []
+    removed = []
+    symProds = {}
+    def addProd(prod):
+        sym = prod[0]
+        if not(sym in symProds):
+            symProds[sym] = []
+        symProds[sym].append(len(prods))
+        prods.append(prod)
+        removed.append(False)
 
     for prod in gram:
-        sym, children, weight, mem = prod
-        if sym == tchild:
+        addProd(prod)
+
+    i = 0
+    while i < len(prods):
+        tsym, tchildren, tweight, tmem = prods[i]
+        if not(len(tchildren) == 1):
+            i += 1
+            continue
+
+        # given our target unit production A->B, find every production from
+        # B->? still in the grammar and add a production from A->?
+        removed[i] = True
+        tchild = tchildren[0]
+        for j in symProds.get(tchild, []):
+            if removed[j]:
+                continue
+            sym, children, weight, mem = prods[j]
             newWeight = tweight + weight
 
             # we need to concatenate the child's memory, then this symbol,
             # then the parent symbols
-            memChain = copy.deepcopy(mem[0])
+            memChain = list(mem[0])
             memChain.append(sym)
             memChain.extend(tmem[0])
             newMem = [memChain, mem[1]]
 
-            newProd = (tsym, children, newWeight, newMem)
-            newGram.append(newProd)
+            addProd((tsym, children, newWeight, newMem))
 
-    # go through the lexicon and add unit productions to that where necessary
-    if tchild in lexMap:
-        for entry in lexMap[tchild]:
+        # add lexicon entries for A wherever B has them
+        for entry in lexMap.get(tchild, []):
             val, index = entry
-            sym, weight, mem = lex[val][index]
+            sym, weight, mem = newLex[val][index]
 
             newWeight = tweight + weight
 
-            # we need to concatenate the child's memory, then this symbol,
-            # then the parent symbols
-            memChain = copy.deepcopy(mem[0])
+            memChain = list(mem[0])
             memChain.append(sym)
             memChain.extend(tmem[0])
             newMem = [memChain, mem[1]]
 
             newProd = (tsym, newWeight, newMem)
-            newProdIndex = len(lex[val])
+            newProdIndex = len(newLex[val])
 
-            lex[val].append(newProd)
-            if not(tsym) in lexMap:
+            newLex[val].append(newProd)
+            if not(tsym in lexMap):
                 lexMap[tsym] = []
             lexMap[tsym].append([val, newProdIndex])
 
-    # recursively call this function to remove any new unit productions
-    return cnfRemoveUnits(lex, newGram, lexMap)
+        i += 1
+
+    newGram = []
+    for j, prod in enumerate(prods):
+        if not(removed[j]):
+            newGram.append(prod)
+
+    return newLex, newGram
 
 # given a production, produce a list of productions where each has
 # two children. We also keep track of how many new symbols we create.
@@ -176,75 +222,798 @@ def convertGrammarToCNF(lex, gram):
 
 
 # ===========================================================================
-# ============================= CKY Calculation =============================
+# ============================ Compiled Grammars ============================
 # ===========================================================================
 
-# create an empty CKY chart
-# N is size
-def createEmpty(N):
-    arr = []
-    for i in range(N):
-        subArr = []
-        for j in range(N):
-            subArr.append([])
-        arr.append(subArr)
-    return arr
+# holds a grammar in CNF form with symbols replaced by integer IDs and the
+# binary rules indexed by their children. Conversion to CNF is expensive, so
+# it is done lazily the first time the grammar is needed and then reused for
+# every line parsed with it.
+class CompiledGrammar(object):
+    def __init__(self, gram, lex=None):
+        self.rawGram = gram
+        if lex == None:
+            lex = {}
+        self.rawLex = lex
+        self.compiled = False
+
+    # convert the grammar to CNF and build the symbol table and rule index.
+    # Does nothing if this grammar has already been compiled.
+    def compile(self):
+        if self.compiled:
+            return self
+
+        lex, gram = convertGrammarToCNF(self.rawLex, self.rawGram)
+
+        # assign IDs to symbols in order of first appearance
+        self.symbols = []
+        self.symbolIDs = {}
+        for prod in gram:
+            a, b, c, _, _ = prod
+            for sym in [a, b, c]:
+                self.addSymbol(sym)
+        for key in lex:
+            for prod in lex[key]:
+                self.addSymbol(prod[0])
+
+        # lexicon with symbol IDs
+        self.lex = {}
+        for key in lex:
+            self.lex[key] = []
+            for prod in lex[key]:
+                sym, weight, mem = prod
+                self.lex[key].append((self.symbolIDs[sym], weight, mem))
+
+        # binary rules with symbol IDs
+        self.rules = []
+        for prod in gram:
+            a, b, c, vec, mem = prod
+            self.rules.append((self.symbolIDs[a], self.symbolIDs[b], self.symbolIDs[c], vec, mem))
+
+        self.ruleMap = convertGrammarToMap(self.rules)
+
+        # bitsets for recognizing; for each left child symbol, a mask of
+        # the down child symbols it combines with, and for each pair a mask
+        # of the symbols they produce
+        self.downMasks = [0] * len(self.symbols)
+        self.parentMasks = {}
+        for a, b, c, _, _ in self.rules:
+            self.downMasks[b] |= 1 << c
+            self.parentMasks[(b, c)] = self.parentMasks.get((b, c), 0) | (1 << a)
+        # results of combining pairs of cell bitsets
+        self.combineCache = {}
+
+        # bounds on the yields of symbols; see getYieldBounds
+        self.yieldBounds = {}
+        # symbols that can begin each symbol; see getLeftCornerMasks
+        self.leftCornerMasks = None
+
+        self.compiled = True
+        return self
+
+    # add a symbol to the symbol table if it isn't there already
+    def addSymbol(self, sym):
+        if not(sym in self.symbolIDs):
+            self.symbolIDs[sym] = len(self.symbols)
+            self.symbols.append(sym)
+
+    # return the ID of a symbol, or -1 if the grammar does not use it
+    def getSymbolID(self, sym):
+        return self.symbolIDs.get(sym, -1)
+
+    # return the IDs of the given symbols that the grammar uses
+    def getSymbolIDs(self, syms):
+        ids = []
+        for sym in syms:
+            symID = self.getSymbolID(sym)
+            if symID >= 0:
+                ids.append(symID)
+        return ids
+
+    # return the name of a symbol ID
+    def getSymbolName(self, symID):
+        return self.symbols[symID]
+
+    # return a bitset of the given symbols that the grammar uses
+    def getSymbolMask(self, syms):
+        mask = 0
+        for symID in self.getSymbolIDs(syms):
+            mask |= 1 << symID
+        return mask
+
+    # given bitsets of the symbols in a left and a down cell, return the
+    # bitset of symbols that can be built from them
+    def combineMasks(self, leftMask, downMask):
+        key = (leftMask, downMask)
+        if key in self.combineCache:
+            return self.combineCache[key]
+
+        result = 0
+        remaining = leftMask
+        while remaining:
+            low = remaining & -remaining
+            remaining ^= low
+            b = low.bit_length() - 1
+            matches = downMask & self.downMasks[b]
+            while matches:
+                lowC = matches & -matches
+                matches ^= lowC
+                c = lowC.bit_length() - 1
+                result |= self.parentMasks[(b, c)]
+
+        self.combineCache[key] = result
+        return result
+
+    # return the YieldBounds of this grammar's symbols when the symbols in
+    # the bitset leafMask are inserted into the chart and parses must be
+    # rooted at a symbol in the bitset rootMask
+    def getYieldBounds(self, leafMask, rootMask):
+        key = (leafMask, rootMask)
+        if not(key in self.yieldBounds):
+            self.yieldBounds[key] = YieldBounds(self, leafMask, rootMask)
+        return self.yieldBounds[key]
+
+    # return, for each symbol, the bitset of symbols that can begin one of
+    # its derivations, including the symbol itself
+    def getLeftCornerMasks(self):
+        if self.leftCornerMasks == None:
+            masks = [1 << sym for sym in range(len(self.symbols))]
+            changed = True
+            while changed:
+                changed = False
+                for a, b, _, _, _ in self.rules:
+                    mask = masks[a] | masks[b]
+                    if not(mask == masks[a]):
+                        masks[a] = mask
+                        changed = True
+            self.leftCornerMasks = masks
+        return self.leftCornerMasks
+
+# repeatedly apply update, which returns True if it tightened or loosened any
+# bound, until nothing changes. Bounds that still change after as many rounds
+# as there are symbols can only come from recursion and are set to infinity
+# by update when unbounded is True.
+def iterateBounds(update, numSymbols):
+    for _ in range(numSymbols + 1):
+        if not(update(False)):
+            return
+    while update(True):
+        pass
+
+# holds, for each symbol of a grammar, bounds on how many inserted entries
+# (syllables, for the meter grammars) it can cover, and how many can come
+# before and after it in a parse. Bounds are inclusive; a symbol with no
+# possible yield has a minimum of infinity and a maximum of -1, and bounds
+# are infinite for symbols that can be built recursively.
+YIELD_MIN = 0
+YIELD_MAX = 1
+YIELD_LEFT_MIN = 2
+YIELD_LEFT_MAX = 3
+YIELD_RIGHT_MIN = 4
+YIELD_RIGHT_MAX = 5
+
+class YieldBounds(object):
+    def __init__(self, grammar, leafMask, rootMask):
+        S = len(grammar.symbols)
+        inf = float("inf")
+        rules = grammar.rules
+        self.minYield = [inf] * S
+        self.maxYield = [-1] * S
+        for sym in range(S):
+            if (leafMask >> sym) & 1:
+                self.minYield[sym] = 1
+                self.maxYield[sym] = 1
+
+        minYield = self.minYield
+        maxYield = self.maxYield
+        def updateYields(unbounded):
+            changed = False
+            for a, b, c, _, _ in rules:
+                if maxYield[b] < 0 or maxYield[c] < 0:
+                    continue
+                low = minYield[b] + minYield[c]
+                high = maxYield[b] + maxYield[c]
+                if low < minYield[a]:
+                    minYield[a] = low
+                    changed = True
+                if high > maxYield[a]:
+                    maxYield[a] = inf if unbounded else high
+                    changed = True
+            return changed
+        iterateBounds(updateYields, S)
+
+        self.minLeft = [inf] * S
+        self.maxLeft = [-1] * S
+        self.minRight = [inf] * S
+        self.maxRight = [-1] * S
+        for sym in range(S):
+            if (rootMask >> sym) & 1:
+                self.minLeft[sym] = 0
+                self.maxLeft[sym] = 0
+                self.minRight[sym] = 0
+                self.maxRight[sym] = 0
+
+        minLeft = self.minLeft
+        maxLeft = self.maxLeft
+        minRight = self.minRight
+        maxRight = self.maxRight
+        def widen(bounds, sym, low, high, unbounded):
+            minBound, maxBound = bounds
+            changed = False
+            if low < minBound[sym]:
+                minBound[sym] = low
+                changed = True
+            if high > maxBound[sym]:
+                maxBound[sym] = inf if unbounded else high
+                changed = True
+            return changed
+        def updateContexts(unbounded):
+            changed = False
+            for a, b, c, _, _ in rules:
+                if maxLeft[a] < 0 or maxYield[b] < 0 or maxYield[c] < 0:
+                    continue
+                # the left child has the parent's left context and the down
+                # child's yield added to its right context, and vice versa
+                changed |= widen((minLeft, maxLeft), b, minLeft[a], maxLeft[a], unbounded)
+                changed |= widen((minRight, maxRight), b, minRight[a] + minYield[c],
+                                 maxRight[a] + maxYield[c], unbounded)
+                changed |= widen((minLeft, maxLeft), c, minLeft[a] + minYield[b],
+                                 maxLeft[a] + maxYield[b], unbounded)
+                changed |= widen((minRight, maxRight), c, minRight[a], maxRight[a], unbounded)
+            return changed
+        iterateBounds(updateContexts, S)
+
+        self.bounds = [minYield, maxYield, minLeft, maxLeft, minRight, maxRight]
+        self.maskCache = {}
+
+    # return a bitset of the symbols whose bounds of the given kind (YIELD_MIN
+    # for the yield, YIELD_LEFT_MIN or YIELD_RIGHT_MIN for the contexts)
+    # overlap the range from low to high
+    def getMask(self, kind, low, high):
+        key = (kind, low, high)
+        if key in self.maskCache:
+            return self.maskCache[key]
+
+        minBound = self.bounds[kind]
+        maxBound = self.bounds[kind + 1]
+        mask = 0
+        for sym in range(len(minBound)):
+            if minBound[sym] <= high and maxBound[sym] >= low:
+                mask |= 1 << sym
+
+        self.maskCache[key] = mask
+        return mask
+
+# return a compiled version of the given grammar. The grammar can be either
+# a list of productions or a CompiledGrammar.
+def getCompiledGrammar(inGram, inLex=None):
+    if isinstance(inGram, CompiledGrammar):
+        return inGram.compile()
+    return CompiledGrammar(inGram, inLex).compile()
+
 
-# initialize the first cells based on the lexicon
-def initFromLex(chart, tokens, lex):
+# ===========================================================================
+# =============================== Statistics ================================
+# ===========================================================================
+
+# holds counts and timings from parsing one or more lines, for finding out
+# why some lines are slow. Parsers fill in what applies to them:
+# - lines: lines parsed
+# - cellsFilled: chart cells with at least one entry built in them
+# - entriesCreated: entries built, not counting inserted ones
+# - cellEntries: maps cells (row, column) to the entries built there
+# - pairsTried: pairs of left and down entries next to each other
+# - pairsMatched: pairs of those with a rule between their symbols
+# - entriesReachable: entries that are part of a parse
+# - latticeSpans: spans put in an automaton's lattice (see FSA.py)
+# - statesKept: (state, position) pairs an automaton search kept a best
+#   path for
+# - arcsTried: arcs an automaton search followed, once for each span of a
+#   span arc
+# - arcsKept: arcs of those that led to a state with a best path
+# - parsesExtracted: parses returned
+# - linesOverBudget: lines whose parse ran out of its budget (see ParseBudget)
+# - phaseTimes: maps phase names to the seconds spent in them
+# - lineTimes: (seconds, label) for each line timed with addLineTime
+class ParseStats(object):
+    def __init__(self):
+        self.lines = 0
+        self.cellsFilled = 0
+        self.entriesCreated = 0
+        self.cellEntries = {}
+        self.pairsTried = 0
+        self.pairsMatched = 0
+        self.entriesReachable = 0
+        self.latticeSpans = 0
+        self.statesKept = 0
+        self.arcsTried = 0
+        self.arcsKept = 0
+        self.parsesExtracted = 0
+        self.linesOverBudget = 0
+        self.latticeHits = 0
+        self.latticeMisses = 0
+        self.phaseTimes = {}
+        self.lineTimes = []
+        self.phaseStart = time.time()
+
+    # start timing a phase
+    def startPhase(self):
+        self.phaseStart = time.time()
+
+    # end the phase being timed, adding its time to the given phase name,
+    # and start timing the next one
+    def endPhase(self, phase):
+        now = time.time()
+        self.phaseTimes[phase] = self.phaseTimes.get(phase, 0) + now - self.phaseStart
+        self.phaseStart = now
+
+    # record how long a whole line took, with a label for finding it again
+    def addLineTime(self, seconds, label):
+        self.lineTimes.append((seconds, label))
+
+    # add the counts and timings of another ParseStats to these
+    def merge(self, other):
+        self.lines += other.lines
+        self.cellsFilled += other.cellsFilled
+        self.entriesCreated += other.entriesCreated
+        for cell in other.cellEntries:
+            self.cellEntries[cell] = self.cellEntries.get(cell, 0) + other.cellEntries[cell]
+        self.pairsTried += other.pairsTried
+        self.pairsMatched += other.pairsMatched
+        self.entriesReachable += other.entriesReachable
+        self.latticeSpans += other.latticeSpans
+        self.statesKept += other.statesKept
+        self.arcsTried += other.arcsTried
+        self.arcsKept += other.arcsKept
+        self.parsesExtracted += other.parsesExtracted
+        self.linesOverBudget += other.linesOverBudget
+        self.latticeHits += other.latticeHits
+        self.latticeMisses += other.latticeMisses
+        for phase in other.phaseTimes:
+            self.phaseTimes[phase] = self.phaseTimes.get(phase, 0) + other.phaseTimes[phase]
+        self.lineTimes.extend(other.lineTimes)
+
+    # return the labels and times of the slowest n lines, slowest first
+    def getSlowestLines(self, n):
+        return sorted(self.lineTimes, key=lambda lt: -lt[0])[:n]
+
+    # return a readable summary. The counts of the chart and of the automaton
+    # search are only given for the ones that did some work.
+    def getReport(self, numSlowest=5):
+        s = []
+        s.append("Lines: %d" % self.lines)
+        if self.cellsFilled > 0 or self.pairsTried > 0:
+            s.append("Cells filled: %d" % self.cellsFilled)
+            s.append("Entries built: %d" % self.entriesCreated)
+            if len(self.cellEntries) > 0:
+                s.append("Most entries built in a cell: %d" % max(self.cellEntries.values()))
+            s.append("Pairs matched: %d of %d tried" % (self.pairsMatched, self.pairsTried))
+            s.append("Entries in a parse: %d" % self.entriesReachable)
+        if self.latticeSpans > 0 or self.statesKept > 0:
+            s.append("Lattice spans: %d" % self.latticeSpans)
+            s.append("Automaton states kept: %d" % self.statesKept)
+            s.append("Automaton arcs kept: %d of %d tried" % (self.arcsKept, self.arcsTried))
+        s.append("Parses extracted: %d" % self.parsesExtracted)
+        s.append("Lines over budget: %d" % self.linesOverBudget)
+        s.append("Lattice cache: %d hits, %d misses" % (self.latticeHits, self.latticeMisses))
+        for phase in self.phaseTimes:
+            s.append("Time in %s: %.4fs" % (phase, self.phaseTimes[phase]))
+        slowest = self.getSlowestLines(numSlowest)
+        if len(slowest) > 0:
+            s.append("Slowest lines:")
+            for seconds, label in slowest:
+                s.append("  %.4fs: %s" % (seconds, label))
+        return "\n".join(s)
+
+# raised by a parser when a line runs out of its ParseBudget. reason is
+# "entries" or "time", and amount is how many entries had been built or how
+# many seconds had passed.
+class BudgetExceededError(Exception):
+    def __init__(self, reason, amount):
+        Exception.__init__(self, "Parse budget exceeded: %s (%s)" % (reason, str(amount)))
+        self.reason = reason
+        self.amount = amount
+
+# limits on the work done parsing a single line, so one very ambiguous line
+# can't stall a whole book. maxEntries caps the entries a parser builds and
+# maxSeconds the time since start was called; either can be None for no
+# limit. What counts as an entry depends on the parser, and is what it adds
+# to its ParseStats: CKY counts the chart entries it builds (entriesCreated,
+# not counting inserted ones) and the automaton search counts the (state,
+# position) pairs it keeps (statesKept). Parsers check the budget as they go,
+# after each cell or state they fill, and raise BudgetExceededError once it
+# has run out.
+class ParseBudget(object):
+    def __init__(self, maxEntries=None, maxSeconds=None):
+        self.maxEntries = maxEntries
+        self.maxSeconds = maxSeconds
+        self.startTime = time.time()
+
+    # start the clock for a new line
+    def start(self):
+        self.startTime = time.time()
+
+    # raise BudgetExceededError if more than maxEntries entries have been
+    # built or more than maxSeconds have passed
+    def check(self, numEntries):
+        if not(self.maxEntries == None) and numEntries > self.maxEntries:
+            raise BudgetExceededError("entries", numEntries)
+        if not(self.maxSeconds == None):
+            elapsed = time.time() - self.startTime
+            if elapsed > self.maxSeconds:
+                raise BudgetExceededError("time", elapsed)
+
+# ===========================================================================
+# ============================= CKY Calculation =============================
+# ===========================================================================
+
+# Entries in a chart are tuples of
+# (symbol, start, end, weight vector, back-pointers)
+# Every way of building the same symbol with the same weight vector over
+# the same span shares one entry, so a cell holds at most one entry per
+# distinct symbol and weight vector. Each way is a back-pointer, a tuple of
+# (split, left, right, rule, memory)
+# where left and right are the arena indices of the entries it was built
+# from and rule is the index of the grammar rule that built it. For entries
+# inserted directly into the chart, split is -1 and rule holds the number of
+# entries inserted before this one; left and right are -1 unless the entry
+# was inserted with its children.
+ENTRY_SYM = 0
+ENTRY_START = 1
+ENTRY_END = 2
+ENTRY_VEC = 3
+ENTRY_BACKS = 4
+
+BACK_SPLIT = 0
+BACK_LEFT = 1
+BACK_RIGHT = 2
+BACK_RULE = 3
+BACK_MEM = 4
+
+# the contents of every cell nothing has been put in yet
+EMPTY_CELL = ()
+
+# return the index of the cell at a row and column (row <= column) in a flat
+# array holding the upper triangle of an N x N grid of cells, row by row
+def getCellIndex(N, row, col):
+    return row * N - (row * (row - 1)) // 2 + col - row
+
+# holds a CKY chart. Every entry is stored once in a flat arena and is
+# referred to by its index there; cells hold lists of entry indices. Only
+# the upper triangle of the grid of cells is ever used, so the cells are
+# kept in a flat array (see getCellIndex), and a cell's list is only created
+# once something is put in it. Entries with the same weight vector share
+# one array for it.
+#
+# If pareto is True, runUpwards only keeps the entries of each cell whose
+# weight vectors are Pareto-optimal: an entry is dropped if another entry in
+# the cell with the same symbol and flag state (as for BestChart) has a
+# weight vector no larger in any feature and was built earlier. Features
+# only add up going up the chart, so every parse through the dropped entry
+# has a parse through the other one that comes earlier, with no more of any
+# feature. pickBestParse picks the same parse with or without the dropped
+# entries, but the other parses are not all kept.
+class Chart(object):
+    def __init__(self, N, entries=None, pareto=False, flagIndex=-1):
+        self.N = N
+        self.cells = [EMPTY_CELL] * ((N * (N + 1)) // 2)
+        if entries == None:
+            entries = []
+        self.entries = entries
+        # maps (row, column, symbol, weight vector) to entry indices
+        self.entryMap = {}
+        # maps the types and values of the weight vectors of entries to the
+        # arrays the entries share for them
+        self.vecs = {}
+        # maps cell indices to maps from symbols to the indices of the
+        # entries for them in the cell, in order. Cells are only added once
+        # something is put in them.
+        self.symbolCells = {}
+        self.numInserted = 0
+
+        self.pareto = pareto
+        self.flagIndex = flagIndex
+        # the order of the first derivation of each entry (see BestChart),
+        # only kept when pruning
+        self.firstOrders = []
+        # marks the entries that are part of a parse, once markReachable
+        # has been run; otherwise None
+        self.reachable = None
+
+    def __len__(self):
+        return self.N
+
+    # return the entry indices in the cell at the given row and column
+    def getCell(self, row, col):
+        return self.cells[getCellIndex(self.N, row, col)]
+
+    # return the entry indices in the cell at the given row and column that
+    # are part of a parse, or all of them if the chart hasn't been marked
+    # (see markReachable)
+    def getReachableCell(self, row, col):
+        cell = self.getCell(row, col)
+        if self.reachable is None:
+            return cell
+        return [index for index in cell if self.reachable[index]]
+
+    # replace the entry indices in the cell at the given row and column
+    def setCell(self, row, col, items):
+        self.cells[getCellIndex(self.N, row, col)] = items
+
+    # add an entry index to the cell at the given row and column
+    def addToCell(self, row, col, index):
+        cellIndex = getCellIndex(self.N, row, col)
+        if self.cells[cellIndex] is EMPTY_CELL:
+            self.cells[cellIndex] = []
+        self.cells[cellIndex].append(index)
+
+    # add a way of building a symbol with a weight vector to the cell at the
+    # given row and column, merging it into the entry already there for
+    # them if there is one. Returns the index of the entry.
+    def addDerivation(self, row, col, sym, vec, back):
+        vecKey = tuple(vec.tolist())
+        key = (row, col, sym, vecKey)
+        index = self.entryMap.get(key, -1)
+        if index < 0:
+            sharedKey = (vec.dtype.char, vecKey)
+            if sharedKey in self.vecs:
+                vec = self.vecs[sharedKey]
+            else:
+                self.vecs[sharedKey] = vec
+            index = len(self.entries)
+            self.entries.append((sym, row, col + 1, vec, [back]))
+            self.addToCell(row, col, index)
+            self.entryMap[key] = index
+
+            cellKey = getCellIndex(self.N, row, col)
+            if not(cellKey in self.symbolCells):
+                self.symbolCells[cellKey] = {}
+            symbolCell = self.symbolCells[cellKey]
+            if not(sym in symbolCell):
+                symbolCell[sym] = []
+            symbolCell[sym].append(index)
+
+            if self.pareto:
+                self.firstOrders.append(self.getBackOrder(back))
+        else:
+            self.entries[index][ENTRY_BACKS].append(back)
+        return index
+
+    # return the order of the first derivation using a back-pointer.
+    # Derivations are added in order, so for an entry's first back-pointer
+    # this is the order of the entry's first derivation.
+    def getBackOrder(self, back):
+        split, lid, did, rule, _ = back
+        if lid < 0:
+            return (-1, rule)
+        if split < 0:
+            return (-1, rule, self.firstOrders[lid], self.firstOrders[did])
+        return (split, self.firstOrders[lid], self.firstOrders[did], rule)
+
+    # return the flag state of a weight vector
+    def getFlag(self, vec):
+        return self.flagIndex >= 0 and vec[self.flagIndex] > 0
+
+    # add an entry inserted directly into the chart, with the indices of its
+    # children if it was inserted with them
+    def insertEntry(self, row, col, sym, vec, mem, left=-1, right=-1):
+        back = (-1, left, right, self.numInserted, mem)
+        self.numInserted += 1
+        return self.addDerivation(row, col, sym, vec, back)
+
+    # find the entry in a cell with the given symbol and weight vector,
+    # returning -1 if there is none
+    def findEntry(self, row, col, sym, vec):
+        return self.entryMap.get((row, col, sym, tuple(vec.tolist())), -1)
+
+# initialize the first cells based on the lexicon of a compiled grammar
+def initFromLex(chart, tokens, grammar):
+    lex = grammar.lex
     for i, t in enumerate(tokens):
         if not(t in lex):
-            raise "%s not in lexicon" % t
+            raise ValueError("%s not in lexicon" % t)
         for l in lex[t]:
-            # symbol, start, end, memory, weight vector, id
-            entryID = uuid.uuid4()
-            entry = (l[0], i, i+1, l[2], l[1], entryID)
-            chart[i][i].append(entry)
+            chart.insertEntry(i, i, l[0], l[1], l[2])
     return chart
 
-# initialize cells with a map
-def initFromSpans(chart, lexSpans, interiorSpans):
+# initialize cells with a map. Spans whose symbols the grammar does not use
+# can never be part of a parse, so they are left out.
+def initFromSpans(chart, lexSpans, interiorSpans, grammar):
     # case where we are on the diagonal of the chart
     for span in lexSpans:
         sym, start, end, mem, weight = span
-        entryID = uuid.uuid4()
-        newSpan = (sym, start, end, mem, weight, entryID)
-        chart[start][start].append(newSpan)
+        sym = grammar.getSymbolID(sym)
+        if sym < 0:
+            continue
+        chart.insertEntry(start, start, sym, weight, mem)
 
     # if we aren't on the diagonal, setup is a little more complicated
     for span in interiorSpans:
         if len(span) == 5:
             sym, start, end, mem, weight = span
-            entryID = uuid.uuid4()
-            entry = (sym, "", "", -1, [], [], mem, weight, entryID)
+            sym = grammar.getSymbolID(sym)
+            if sym < 0:
+                continue
+            chart.insertEntry(start, end - 1, sym, weight, mem)
         else:
+            # children are given by symbol and weight; point to the first
+            # matching entry already in the chart
             sym, start, split, end, leftInfo, rightInfo, mem, weight = span
+            sym = grammar.getSymbolID(sym)
+            if sym < 0:
+                continue
             leftSym, leftWeight = leftInfo
             rightSym, rightWeight = rightInfo
-            entryID = uuid.uuid4()
-            entry = (sym, leftSym, rightSym, split, leftWeight, rightWeight, mem, weight, entryID)
-        row = start
-        col = end - 1
-        chart[row][col].append(entry)
+            left = chart.findEntry(start, split - 1, grammar.getSymbolID(leftSym), leftWeight)
+            right = chart.findEntry(split, end - 1, grammar.getSymbolID(rightSym), rightWeight)
+            if left < 0 or right < 0:
+                continue
+            chart.insertEntry(start, end - 1, sym, weight, mem, left, right)
     return chart
 
 
-# Convert a grammar in list form to a grammar in map form
+# Convert a grammar in list form to a grammar in map form. Each production
+# is stored along with its index in the list.
 def convertGrammarToMap(gram):
     gramMap = {}
-    for production in gram:
+    for index, production in enumerate(gram):
         a, b, c, vec, mem = production
         if (b in gramMap) and (c in gramMap[b]):
-            gramMap[b][c].append([a, vec, mem])
+            gramMap[b][c].append([a, vec, mem, index])
         else:
             if not(b in gramMap):
                 gramMap[b] = {}
-            gramMap[b][c] = [[a, vec, mem]]
+            gramMap[b][c] = [[a, vec, mem, index]]
     return gramMap
 
-# run CKY upwards on a chart
-def runUpwards(chart, gram):
-    gramMap = convertGrammarToMap(gram)
+# return the (symbol ID, start, end) of each entry initFromLex would insert
+def getLexSpans(tokens, grammar):
+    spans = []
+    lex = grammar.lex
+    for i, t in enumerate(tokens):
+        if not(t in lex):
+            raise ValueError("%s not in lexicon" % t)
+        for l in lex[t]:
+            spans.append((l[0], i, i+1))
+    return spans
+
+# return the (symbol ID, start, end) of each entry initFromSpans would
+# insert, leaving out spans with symbols the grammar does not use
+def getInitSpans(init, grammar):
+    spans = []
+    for span in init[0] + init[1]:
+        sym = grammar.getSymbolID(span[0])
+        if sym < 0:
+            continue
+        if len(span) == 5:
+            spans.append((sym, span[1], span[2]))
+        else:
+            spans.append((sym, span[1], span[3]))
+    return spans
+
+# return the fewest and most spans on any path of adjacent spans between two
+# positions, as maps from (start, end) to counts. spans is a list of (start,
+# end) pairs. Every position where a span starts or ends reaches itself with
+# no spans.
+def getSpanCounts(spans):
+    nexts = {}
+    positions = set()
+    for start, end in spans:
+        positions.add(start)
+        positions.add(end)
+        if not(start in nexts):
+            nexts[start] = set()
+        nexts[start].add(end)
+    positions = sorted(positions)
+
+    minCounts = {}
+    maxCounts = {}
+    for first in positions:
+        minCounts[(first, first)] = 0
+        maxCounts[(first, first)] = 0
+        for pos in positions:
+            if not((first, pos) in minCounts):
+                continue
+            low = minCounts[(first, pos)] + 1
+            high = maxCounts[(first, pos)] + 1
+            for end in nexts.get(pos, []):
+                key = (first, end)
+                if not(key in minCounts):
+                    minCounts[key] = low
+                    maxCounts[key] = high
+                else:
+                    minCounts[key] = min(minCounts[key], low)
+                    maxCounts[key] = max(maxCounts[key], high)
+
+    return minCounts, maxCounts
+
+# return the cells and symbols that can be part of a parse of N tokens,
+# given how many spans each symbol can cover and have before and after it
+# (see YieldBounds), as a map from cells (row, column) to bitsets of symbols
+# like the allowed map of BestChart. spans holds the (symbol ID, start, end)
+# of every entry inserted into the chart, and root the root symbol IDs.
+# Returns None if no parse can fit the tokens at all, such as when a line is
+# far too short or too long for a meter.
+def getYieldAllowed(N, spans, grammar, root):
+    leafMask = 0
+    for sym, _, _ in spans:
+        leafMask |= 1 << sym
+    rootMask = 0
+    for sym in root:
+        rootMask |= 1 << sym
+    bounds = grammar.getYieldBounds(leafMask, rootMask)
+
+    minCounts, maxCounts = getSpanCounts([(start, end) for _, start, end in spans])
+    if not((0, N) in minCounts):
+        return None
+    if not(bounds.getMask(YIELD_MIN, minCounts[(0, N)], maxCounts[(0, N)]) & rootMask):
+        return None
+
+    allowed = {}
+    for key in minCounts:
+        start, end = key
+        if start == end:
+            continue
+        if not((0, start) in minCounts) or not((end, N) in minCounts):
+            continue
+        mask = bounds.getMask(YIELD_MIN, minCounts[key], maxCounts[key])
+        mask &= bounds.getMask(YIELD_LEFT_MIN, minCounts[(0, start)], maxCounts[(0, start)])
+        mask &= bounds.getMask(YIELD_RIGHT_MIN, minCounts[(end, N)], maxCounts[(end, N)])
+        if mask:
+            allowed[(start, end - 1)] = mask
+
+    return allowed
+
+# drop the entries of a cell whose weight vectors are not Pareto-optimal
+# (see Chart)
+def pruneCell(chart, row, col):
+    cell = chart.getCell(row, col)
+    if len(cell) < 2:
+        return
+
+    # group the entries by symbol and flag state, in the order they were
+    # built
+    groups = {}
+    for index in cell:
+        sym, _, _, vec, _ = chart.entries[index]
+        key = (sym, chart.getFlag(vec))
+        if not(key in groups):
+            groups[key] = []
+        groups[key].append(index)
+
+    dropped = set()
+    for key in groups:
+        group = groups[key]
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda index: chart.firstOrders[index])
+        vecs = np.array([chart.entries[index][ENTRY_VEC] for index in group])
+        for i in range(1, len(group)):
+            if np.any(np.all(vecs[:i] <= vecs[i], axis=1)):
+                dropped.add(group[i])
+
+    if len(dropped) > 0:
+        chart.setCell(row, col, [index for index in cell if not(index in dropped)])
+        symbolCell = chart.symbolCells[getCellIndex(len(chart), row, col)]
+        for sym in symbolCell:
+            symbolCell[sym] = [index for index in symbolCell[sym] if not(index in dropped)]
+
+# run CKY upwards on a chart. Only pairs of left and down entries with a rule
+# between their symbols are combined, found through the symbol index of each
+# cell, and they are combined in the order of their cells so entries are
+# built in the same order as by trying every pair. If allowed is given, it
+# maps cells (row, column) to bitsets of the symbols that may be built there
+# (see getYieldAllowed), and everything else is skipped. If the chart was
+# created with pareto set, each cell is pruned once it is filled. If stats
+# is given, the cells, entries and pairs of entries are counted in it (see
+# ParseStats). If budget is given, it is checked after each cell (see
+# ParseBudget), so the counts so far are in stats if it runs out.
+def runUpwards(chart, grammar, allowed=None, stats=None, budget=None):
+    gramMap = grammar.ruleMap
+    cells = chart.cells
+    symbolCells = chart.symbolCells
+    entries = chart.entries
+    numInserted = len(entries)
 
     N = len(chart)
     # i goes across the top row
@@ -253,6 +1022,14 @@ def runUpwards(chart, gram):
         for j in range(0, N-i):
             myCol = i + j
             myRow = j
+            cellMask = -1
+            if not(allowed == None):
+                cellMask = allowed.get((myRow, myCol), 0)
+                if not(cellMask):
+                    continue
+            numEntries = len(entries)
+            pairsTried = 0
+            pairsMatched = 0
             # we need to check each possible combination of split
             for k in range(0, i):
                 # for this combination, get how far left and how far down
@@ -260,93 +1037,120 @@ def runUpwards(chart, gram):
                 left = i - k
                 down = k + 1
 
-                rawLeftItems = chart[myRow][myCol - left]
-                rawDownItems = chart[myRow + down][myCol]
-                leftItems = rawLeftItems
-                downItems = rawDownItems
-
-                # for each pair of items, if they are part of a production
-                # in the grammar, add a new entry
-                for leftItem in leftItems:
-                    for downItem in downItems:
-                        b = leftItem[0]
-                        c = downItem[0]
-                        if b in gramMap:
-                            if c in gramMap[b]:
-                                for possible in gramMap[b][c]:
-                                    pSym, pVec, pMem = possible
-                                    weightVec = leftItem[-2] + downItem[-2] + pVec
-                                    split = myCol - left + 1
-                                    entryID = uuid.uuid4()
-                                    entry = (pSym, b, c, split, leftItem[-1], downItem[-1], pMem, weightVec, entryID)
-                                    chart[myRow][myCol].append(entry)
+                leftCell = getCellIndex(N, myRow, myCol - left)
+                leftSyms = symbolCells.get(leftCell)
+                if not(leftSyms):
+                    continue
+                downCell = getCellIndex(N, myRow + down, myCol)
+                downSyms = symbolCells.get(downCell)
+                if not(downSyms):
+                    continue
+                split = myCol - left + 1
+                pairsTried += len(cells[leftCell]) * len(cells[downCell])
+
+                # for each left symbol, find the down entries whose symbols
+                # it has rules with, in the order they are in their cell
+                matches = {}
+                for b in leftSyms:
+                    if not(b in gramMap):
+                        continue
+                    bMap = gramMap[b]
+                    downMatches = []
+                    numSyms = 0
+                    for c in downSyms:
+                        if c in bMap:
+                            downMatches.extend(downSyms[c])
+                            numSyms += 1
+                    if numSyms > 1:
+                        downMatches.sort()
+                    if numSyms > 0:
+                        matches[b] = (bMap, downMatches)
+                if len(matches) == 0:
+                    continue
+
+                # join the matching pairs of items, adding a way of building
+                # the new entry for each rule they are part of
+                for leftIndex in cells[leftCell]:
+                    leftItem = entries[leftIndex]
+                    b = leftItem[ENTRY_SYM]
+                    if not(b in matches):
+                        continue
+                    bMap, downMatches = matches[b]
+                    pairsMatched += len(downMatches)
+                    for downIndex in downMatches:
+                        downItem = entries[downIndex]
+                        pairVec = leftItem[ENTRY_VEC] + downItem[ENTRY_VEC]
+                        for possible in bMap[downItem[ENTRY_SYM]]:
+                            pSym, pVec, pMem, pRule = possible
+                            if not((cellMask >> pSym) & 1):
+                                continue
+                            weightVec = pairVec + pVec
+                            back = (split, leftIndex, downIndex, pRule, pMem)
+                            chart.addDerivation(myRow, myCol, pSym, weightVec, back)
+
+            if not(stats == None):
+                stats.pairsTried += pairsTried
+                stats.pairsMatched += pairsMatched
+                if len(entries) > numEntries:
+                    stats.cellsFilled += 1
+                    stats.entriesCreated += len(entries) - numEntries
+                    cellKey = (myRow, myCol)
+                    stats.cellEntries[cellKey] = stats.cellEntries.get(cellKey, 0) + len(entries) - numEntries
+
+            if chart.pareto:
+                pruneCell(chart, myRow, myCol)
+
+            if not(budget == None):
+                budget.check(len(entries) - numInserted)
 
     return chart
 
-# run CKY filter on a chart
-def filterChart(chart, root):
+# mark the entries of a chart that are part of a parse rooted at one of the
+# root symbols, a list of root symbol IDs, going down from the top cell and
+# visiting each entry at most once. The marks are kept in chart.reachable,
+# which is also returned.
+def markReachable(chart, root):
     N = len(chart)
+    entries = chart.entries
+    reachable = np.zeros(len(entries), dtype=bool)
+    chart.reachable = reachable
 
     if (N == 0):
-        return chart
-
-    # create a new chart that things will be copied into.
-    newChart = createEmpty(N)
-
-    # add root symbols
-    for fin in chart[0][N-1]:
-        sym = fin[0]
-        if sym in root:
-            newChart[0][N-1].append(fin)
-
-    # go through chart backwards
-    for i in range(0, N-1):
-        layer = N - 1 - i
-        for j in range(0, N - layer):
-            row = j
-            col = layer + j
-            # add stuff that is a child of valid stuff in new chart
-            for entry in newChart[row][col]:
-                _, b, c, split, lid, did, _, _, _ = entry
-                leftCol = split - 1
-                downRow = split
-
-                # get lists of entries that combined to form this
-                leftEntries = chart[row][leftCol]
-                downEntries = chart[downRow][col]
-
-                # copy over valid productions into the new chart
-                # leave others in the old chart
-                remaining = []
-                for le in leftEntries:
-                    if le[-1] == lid:
-                        newChart[row][leftCol].append(le)
-                    else:
-                        remaining.append(le)
-                chart[row][leftCol] = remaining
-
-                remaining = []
-                for de in downEntries:
-                    if de[-1] == did: #de[0] == c and vecMatch:
-                        newChart[downRow][col].append(de)
-                    else:
-                        remaining.append(de)
-                chart[downRow][col] = remaining
-
-
-
-    return newChart
+        return reachable
+
+    # start from the root symbols
+    stack = []
+    for index in chart.getCell(0, N-1):
+        if entries[index][ENTRY_SYM] in root:
+            reachable[index] = True
+            stack.append(index)
+
+    # mark the children of each marked entry
+    while len(stack) > 0:
+        index = stack.pop()
+        for _, lid, did, _, _ in entries[index][ENTRY_BACKS]:
+            if lid >= 0 and not(reachable[lid]):
+                reachable[lid] = True
+                stack.append(lid)
+            if did >= 0 and not(reachable[did]):
+                reachable[did] = True
+                stack.append(did)
+
+    return reachable
 
 # print a chart
-def printChart(chart):
-    s = []
-    for row in chart:
+def printChart(chart, grammar):
+    N = len(chart)
+    for row in range(N):
         s2 = []
-        for items in row:
+        for col in range(N):
+            items = ()
+            if col >= row:
+                items = chart.getReachableCell(row, col)
             if len(items) > 0:
                 s3 = []
-                for item in items:
-                    s3.append(str(item[0]))# + ";" + str(item[-1])[0:3] + ";" + str(item[4])[0:3] + ";" + str(item[5])[0:3])
+                for index in items:
+                    s3.append(grammar.getSymbolName(chart.entries[index][ENTRY_SYM]))
                 s2.append(", ".join(s3))
             else:
                 s2.append("")
@@ -354,157 +1158,681 @@ def printChart(chart):
 
     print("=======")
 
-# get subparses starting from given location
-def getSubParses(chart, row, col, sym, vec, targetID):
-    sps = []
-
-    # handle terminals
-    if (row == col):
-        for entry in chart[row][col]:
-            a, _, _, mem, wvec, id = entry
-            # only select appropriate entry at this cell
-            if targetID == id:
-                # if this had unit productions, recreate them
-                if (len(mem[0]) > 0):
-                    child = {
-                        "sym": mem[0][0],
-                        "vec": wvec,
-                        "span": [row, row+1],
-                        "children": []
-                    }
-                    for i in range(1, len(mem[0])):
-                        child = {
-                            "sym": mem[0][i],
-                            "vec": wvec,
-                            "span": [row, row+1],
-                            "children": [child]
-                        }
-                    newParse = {
-                        "sym": sym,
-                        "vec": wvec,
-                        "span": [row, row+1],
-                        "children": [child]
-                    }
-                else: # otherwise just add this piece
-                    newParse = {
-                        "sym": sym,
-                        "vec": wvec,
-                        "span": [row, row+1],
-                        "children": []
-                    }
-                sps.append(newParse)
-
-        return sps
-
-    # handle productions
-    for entry in chart[row][col]:
-        numAdded = 0
-        a, b, c, split, lid, did, mem, wvec, id = entry
-        # only examine proper entry in the chart
-        if id == targetID:
-            # if this entry was inserted during creation and doesn't have
-            # children, don't try to analyze the children
-            if (b == "" and c == ""):
-                newParse = {
-                    "sym": sym,
-                    "vec": wvec,
-                    "span": [row, col+1],
-                    "children": []
-                }
-                sps.append(newParse)
-                numAdded += 1
-            elif targetID == id:
-                leftCol = split - 1
-                downRow = split
-
-                # get lists of entries that combined to form this
-                leftEntries = chart[row][leftCol]
-                downEntries = chart[downRow][col]
-
-                # find child productions
-                validLeftParses = []
-                for le in leftEntries:
-                    if le[-1] == lid:
-                        leftParses = getSubParses(chart, row, leftCol, le[0], le[-2], le[-1])
-                        validLeftParses.extend(leftParses)
-
-                validDownParses = []
-                for de in downEntries:
-                    if de[-1] == did:
-                        downParses = getSubParses(chart, downRow, col, de[0], de[-2], de[-1])
-                        validDownParses.extend(downParses)
-
-                # for each combination of valid left and right children, add
-                # the parse.
-                for vlp in validLeftParses:
-                    for vdp in validDownParses:
-                        # if this was a constructed production, our actual children
-                        # are the down child's children
-                        if mem[1]:
-                            children = [vlp]
-                            children.extend(vdp["children"])
-                        else:
-                            children = [vlp, vdp]
-
-                        # re-extend unitary chains
-                        if (len(mem[0]) > 0):
-                            child = {
-                                "sym": mem[0][0],
-                                "vec": wvec,
-                                "span": [row, col+1],
-                                "children": children
-                            }
-                            for i in range(1, len(mem[0])):
-                                child = {
-                                    "sym": mem[0][i],
-                                    "vec": wvec,
-                                    "span": [row, col+1],
-                                    "children": [child]
-                                }
-                            newParse = {
-                                "sym": sym,
-                                "vec": wvec,
-                                "span": [row, col+1],
-                                "children": [child]
-                            }
-                        else:
-                            newParse = {
-                                "sym": sym,
-                                "vec": wvec,
-                                "span": [row, col+1],
-                                "children": children
-                            }
-                        sps.append(newParse)
-                        numAdded += 1
+# build a parse node, re-extending any chain of unit productions that was
+# folded into this one during CNF conversion
+def buildParse(sym, wvec, start, end, unitChain, children):
+    if (len(unitChain) > 0):
+        child = {
+            "sym": unitChain[0],
+            "vec": wvec,
+            "span": [start, end],
+            "children": children
+        }
+        for i in range(1, len(unitChain)):
+            child = {
+                "sym": unitChain[i],
+                "vec": wvec,
+                "span": [start, end],
+                "children": [child]
+            }
+        children = [child]
+
+    return {
+        "sym": sym,
+        "vec": wvec,
+        "span": [start, end],
+        "children": children
+    }
 
+# get the children of a parse node built from a left and a down parse
+def getParseChildren(mem, leftParse, downParse):
+    # if this was a constructed production, our actual children
+    # are the down child's children
+    if mem[1]:
+        children = [leftParse]
+        children.extend(downParse["children"])
+    else:
+        children = [leftParse, downParse]
+    return children
+
+# get the subparses of an entry from the subparses of its children, as a
+# list of (order, parse) pairs sorted by order (see BestChart for how orders
+# compare). memo must already hold the subparses of the entry's children.
+# If firstOnly is True, only the first subparse is returned.
+def expandEntry(chart, grammar, index, memo, firstOnly=False):
+    sps = []
+    a, start, end, wvec, backs = chart.entries[index]
+    sym = grammar.getSymbolName(a)
+
+    # when only the first subparse is needed, find the back-pointer it comes
+    # from before building it. Orders only grow with the orders of the
+    # children, so it is built from the first subparses of its children.
+    if firstOnly:
+        firstBack = None
+        firstOrder = None
+        for back in backs:
+            split, lid, did, rule, _ = back
+            if lid < 0:
+                order = (-1, rule)
+            else:
+                leftOrder = memo[lid][0][0]
+                downOrder = memo[did][0][0]
+                if split < 0:
+                    order = (-1, rule, leftOrder, downOrder)
+                else:
+                    order = (split, leftOrder, downOrder, rule)
+            if firstBack == None or order < firstOrder:
+                firstBack = back
+                firstOrder = order
+        backs = [firstBack]
+
+    for split, lid, did, rule, mem in backs:
+        # handle entries that were inserted directly into the chart
+        if lid < 0:
+            # if this had unit productions, recreate them
+            if (end == start + 1):
+                newParse = buildParse(sym, wvec, start, end, mem[0], [])
+            else: # otherwise just add this piece
+                newParse = buildParse(sym, wvec, start, end, [], [])
+            sps.append(((-1, rule), newParse))
+            continue
+
+        # handle productions
+        validLeftParses = memo[lid]
+        validDownParses = memo[did]
+
+        # for each combination of valid left and right children, add
+        # the parse.
+        for leftOrder, vlp in validLeftParses:
+            for downOrder, vdp in validDownParses:
+                children = getParseChildren(mem, vlp, vdp)
+                newParse = buildParse(sym, wvec, start, end, mem[0], children)
+                if split < 0:
+                    order = (-1, rule, leftOrder, downOrder)
+                else:
+                    order = (split, leftOrder, downOrder, rule)
+                sps.append((order, newParse))
+
+    sps.sort(key=lambda sp: sp[0])
     return sps
 
-# extract parses
-def getParses(chart):
+# get the subparses of the entry at the given arena index, as a list of
+# (order, parse) pairs sorted by order. memo holds the subparses of entries
+# already expanded, so an entry shared by many parses is only expanded once.
+# Entries are expanded with an explicit stack, children first, so deep
+# charts do not run into the recursion limit. firstOnly is as for
+# expandEntry, and must be the same for every call sharing a memo.
+def getSubParses(chart, grammar, index, memo, firstOnly=False):
+    entries = chart.entries
+    stack = [index]
+    while len(stack) > 0:
+        top = stack[-1]
+        if top in memo:
+            stack.pop()
+            continue
+
+        # expand the children first
+        waiting = False
+        for _, lid, did, _, _ in entries[top][ENTRY_BACKS]:
+            if lid < 0:
+                continue
+            for child in [lid, did]:
+                if not(child in memo):
+                    stack.append(child)
+                    waiting = True
+        if waiting:
+            continue
+
+        stack.pop()
+        memo[top] = expandEntry(chart, grammar, top, memo, firstOnly)
+
+    return memo[index]
+
+# extract parses, in the order they would have been built in. If firstOnly
+# is True, only the first parse is extracted, in time linear in the size of
+# the chart.
+def getParses(chart, grammar, firstOnly=False):
     parses = []
     N = len(chart)
 
     if (N == 0):
         return parses
 
-    # Get the high level entries
-    topEntries = chart[0][N-1]
-    # for each high level entry
-    for i, entry in enumerate(topEntries):
-        # Check if this is a duplicate of a previous entry
-        unique = True
-        sym, _, _, _, _, _, _, vec, id = entry
-        for j in range(0, i):
-            csym, _, _, _, _, _, _, cvec, cid = topEntries[j]
-            if id == cid:
-                unique = False
-        # if it's not a duplicate entry, get subparses and add them to
-        # the parse list.
-        if unique:
-            sps = getSubParses(chart, 0, N-1, sym, vec, id)
-            parses.extend(sps)
+    # Get the high level entries, skipping duplicates
+    topEntries = chart.getReachableCell(0, N-1)
+    seen = set()
+    found = []
+    memo = {}
+    for index in topEntries:
+        if index in seen:
+            continue
+        seen.add(index)
+        found.extend(getSubParses(chart, grammar, index, memo, firstOnly))
+
+    # the parses of different entries are interleaved in the order they
+    # would have been built in
+    found.sort(key=lambda sp: sp[0])
+    if firstOnly:
+        found = found[:1]
+    for _, parse in found:
+        parses.append(parse)
     return parses
 
+# ===========================================================================
+# =============================== Recognizing ===============================
+# ===========================================================================
+
+# Recognizing only answers whether there is any parse. Each cell is a
+# bitset (an int) of the symbols that can cover it, and cells are combined
+# with bitwise operations; no entries or weights are built.
+
+# create a grid of N x N empty bitsets
+def createEmptyMasks(N):
+    arr = []
+    for i in range(N):
+        arr.append([0] * N)
+    return arr
+
+# run the recognizer upwards on a grid of bitsets and return true if the
+# top cell contains a symbol in rootMask. allowed optionally restricts the
+# symbols built in each cell, as for runUpwards.
+def recognizeUpwards(masks, grammar, rootMask, allowed=None):
+    N = len(masks)
+    if (N == 0):
+        return False
+
+    for i in range(1, N):
+        for j in range(0, N-i):
+            myCol = i + j
+            myRow = j
+            allowedMask = -1
+            if not(allowed == None):
+                allowedMask = allowed.get((myRow, myCol), 0)
+                if not(allowedMask):
+                    continue
+            cellMask = masks[myRow][myCol]
+            for k in range(0, i):
+                left = i - k
+                down = k + 1
+                leftMask = masks[myRow][myCol - left]
+                if not(leftMask):
+                    continue
+                downMask = masks[myRow + down][myCol]
+                if not(downMask):
+                    continue
+                cellMask |= grammar.combineMasks(leftMask, downMask) & allowedMask
+            masks[myRow][myCol] = cellMask
+
+    return (masks[0][N-1] & rootMask) != 0
+
+# return true if the tokens can be parsed with the lexicon and grammar
+def recognize(tokens, inLex, inGram, root):
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram, inLex)
+    spans = getLexSpans(tokens, grammar)
+    allowed = getYieldAllowed(N, spans, grammar, grammar.getSymbolIDs(root))
+    if allowed == None:
+        return False
+    masks = createEmptyMasks(N)
+    for sym, start, _ in spans:
+        masks[start][start] |= 1 << sym
+    return recognizeUpwards(masks, grammar, grammar.getSymbolMask(root), allowed)
+
+# return true if the tokens can be parsed given initialization info for the
+# chart and a grammar
+def recognizeCustomInit(tokens, init, inGram, root):
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram)
+    allowed = getYieldAllowed(N, getInitSpans(init, grammar), grammar, grammar.getSymbolIDs(root))
+    if allowed == None:
+        return False
+    masks = createEmptyMasks(N)
+    for span in init[0]:
+        sym = grammar.getSymbolID(span[0])
+        if sym >= 0:
+            start = span[1]
+            masks[start][start] |= 1 << sym
+    for span in init[1]:
+        sym = grammar.getSymbolID(span[0])
+        if sym < 0:
+            continue
+        if len(span) == 5:
+            start = span[1]
+            end = span[2]
+        else:
+            # spans given with children need their children in the chart
+            _, start, split, end, leftInfo, rightInfo, _, _ = span
+            leftSym = grammar.getSymbolID(leftInfo[0])
+            rightSym = grammar.getSymbolID(rightInfo[0])
+            if leftSym < 0 or not(masks[start][split - 1] & (1 << leftSym)):
+                continue
+            if rightSym < 0 or not(masks[split][end - 1] & (1 << rightSym)):
+                continue
+        masks[start][end - 1] |= 1 << sym
+    return recognizeUpwards(masks, grammar, grammar.getSymbolMask(root), allowed)
+
+
+# ===========================================================================
+# =============================== Parse Forest ==============================
+# ===========================================================================
+
+# A parse forest holds the entries of a chart that are part of a parse as
+# nodes, with each distinct way of building an entry as an edge, so a
+# subtree used by many parses is stored once. An edge is a tuple of
+# (split, left node, down node, rule, memory)
+# For entries inserted directly into the chart split is -1, rule holds the
+# number of entries inserted before this one, and the nodes are None unless
+# the entry was inserted with its children.
+EDGE_SPLIT = 0
+EDGE_LEFT = 1
+EDGE_DOWN = 2
+EDGE_RULE = 3
+EDGE_MEM = 4
+
+# holds a node of a parse forest
+class ForestNode(object):
+    def __init__(self, index, sym, start, end, vec):
+        self.index = index
+        self.sym = sym
+        self.start = start
+        self.end = end
+        self.vec = vec
+        self.edges = []
+
+        # derivations of this node found so far, best first, as tuples of
+        # (order, edge index, left rank, down rank). See BestChart for
+        # how orders compare.
+        self.derivs = []
+        # heap of candidate derivations, created on first use
+        self.candidates = None
+        self.seen = None
+
+# holds a parse forest and the grammar used to build it
+class ParseForest(object):
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.nodes = []
+        self.nodeMap = {}
+        self.edgeKeys = set()
+        self.roots = []
+
+    # return the node for a symbol, span and weight vector, creating it if
+    # it doesn't exist yet
+    def getNode(self, sym, start, end, vec):
+        key = (sym, start, end, tuple(vec.tolist()))
+        if key in self.nodeMap:
+            return self.nodeMap[key]
+        node = ForestNode(len(self.nodes), sym, start, end, vec)
+        self.nodes.append(node)
+        self.nodeMap[key] = node
+        return node
+
+    # add an edge to a node unless an identical one is already there
+    def addEdge(self, node, edge):
+        split, left, down, rule, _ = edge
+        if left == None:
+            key = (node.index, split, rule)
+        else:
+            key = (node.index, split, left.index, down.index, rule)
+        if not(key in self.edgeKeys):
+            self.edgeKeys.add(key)
+            node.edges.append(edge)
+
+# add the entry at the given arena index, and everything below it, to a
+# forest, returning its node
+def addForestEntry(forest, chart, index, entryNodes):
+    if index in entryNodes:
+        return entryNodes[index]
+
+    sym, start, end, vec, backs = chart.entries[index]
+    node = forest.getNode(sym, start, end, vec)
+    entryNodes[index] = node
+
+    for split, lid, did, rule, mem in backs:
+        if lid < 0:
+            edge = (-1, None, None, rule, mem)
+        else:
+            leftNode = addForestEntry(forest, chart, lid, entryNodes)
+            downNode = addForestEntry(forest, chart, did, entryNodes)
+            edge = (split, leftNode, downNode, rule, mem)
+        forest.addEdge(node, edge)
+
+    return node
+
+# build a parse forest from the parses in a chart rooted at one of the root
+# symbols
+def buildForest(chart, grammar, root):
+    forest = ParseForest(grammar)
+    N = len(chart)
+
+    if (N == 0):
+        return forest
+
+    entryNodes = {}
+    for index in chart.getCell(0, N-1):
+        if chart.entries[index][ENTRY_SYM] in root:
+            node = addForestEntry(forest, chart, index, entryNodes)
+            if not(node in forest.roots):
+                forest.roots.append(node)
+
+    return forest
+
+# add the candidate derivation of a node that uses the given edge and the
+# given ranks of its children, if it exists and hasn't been added already
+def pushForestCandidate(node, edgeIndex, leftRank, downRank):
+    key = (edgeIndex, leftRank, downRank)
+    if key in node.seen:
+        return
+    node.seen.add(key)
+
+    split, left, down, rule, _ = node.edges[edgeIndex]
+    if left == None:
+        order = (-1, rule)
+    else:
+        leftDeriv = getNodeDerivation(left, leftRank)
+        downDeriv = getNodeDerivation(down, downRank)
+        if leftDeriv == None or downDeriv == None:
+            return
+        if split < 0:
+            order = (-1, rule, leftDeriv[0], downDeriv[0])
+        else:
+            order = (split, leftDeriv[0], downDeriv[0], rule)
+
+    heapq.heappush(node.candidates, (order, edgeIndex, leftRank, downRank))
+
+# return the k-th derivation of a node in order (counting from 0), or None
+# if it has fewer derivations. Derivations are only worked out as they are
+# asked for.
+def getNodeDerivation(node, k):
+    if node.candidates == None:
+        node.candidates = []
+        node.seen = set()
+        for edgeIndex in range(len(node.edges)):
+            pushForestCandidate(node, edgeIndex, 0, 0)
+
+    while len(node.derivs) <= k and len(node.candidates) > 0:
+        deriv = heapq.heappop(node.candidates)
+        node.derivs.append(deriv)
+
+        _, edgeIndex, leftRank, downRank = deriv
+        if not(node.edges[edgeIndex][EDGE_LEFT] == None):
+            pushForestCandidate(node, edgeIndex, leftRank + 1, downRank)
+            pushForestCandidate(node, edgeIndex, leftRank, downRank + 1)
+
+    if k < len(node.derivs):
+        return node.derivs[k]
+    return None
+
+# build the parse for the k-th derivation of a forest node
+def getForestParse(forest, node, k):
+    _, edgeIndex, leftRank, downRank = node.derivs[k]
+    split, left, down, rule, mem = node.edges[edgeIndex]
+    sym = forest.grammar.getSymbolName(node.sym)
+    start = node.start
+    end = node.end
+
+    if left == None:
+        if (end == start + 1):
+            return buildParse(sym, node.vec, start, end, mem[0], [])
+        return buildParse(sym, node.vec, start, end, [], [])
+
+    leftParse = getForestParse(forest, left, leftRank)
+    downParse = getForestParse(forest, down, downRank)
+    children = getParseChildren(mem, leftParse, downParse)
+    return buildParse(sym, node.vec, start, end, mem[0], children)
+
+# lazily yield the parses in a forest, best first. Parses are ordered by
+# rankKey applied to their weight vector, then by the order getParses would
+# return them in. With no rankKey, this gives the same list as getParses.
+def iterForestParses(forest, rankKey=None):
+    heap = []
+    for n, node in enumerate(forest.roots):
+        deriv = getNodeDerivation(node, 0)
+        if not(deriv == None):
+            rank = ()
+            if not(rankKey == None):
+                rank = tuple(rankKey(node.vec))
+            heapq.heappush(heap, (rank, deriv[0], n, 0))
+
+    while len(heap) > 0:
+        rank, _, n, k = heapq.heappop(heap)
+        node = forest.roots[n]
+        yield getForestParse(forest, node, k)
+
+        deriv = getNodeDerivation(node, k + 1)
+        if not(deriv == None):
+            heapq.heappush(heap, (rank, deriv[0], n, k + 1))
+
+
+# ===========================================================================
+# ============================ Best Parse Search ============================
+# ===========================================================================
+
+# Instead of building every entry, the best parse search keeps, for each
+# cell, symbol and flag state, only the best derivation under each of a list
+# of costs. A cost is a weight array; the cost of a derivation is the dot
+# product of that array with the derivation's weight vector, and ties are
+# broken by the order getParses would return the derivations in. When
+# flagIndex is given, derivations where that feature is nonzero are kept
+# apart from those where it is zero, so the best of each kind survives.
+#
+# A derivation is a tuple of
+# (order, symbol, start, end, memory, weight vector, left, right)
+# where left and right are the child derivations, or None for entries
+# inserted directly into the chart. order is (-1, init index) for inserted
+# entries and (split, left order, down order, rule index) for built ones;
+# comparing these nested tuples gives the order the entries would have in
+# a full chart.
+DERIV_ORDER = 0
+DERIV_SYM = 1
+DERIV_START = 2
+DERIV_END = 3
+DERIV_MEM = 4
+DERIV_VEC = 5
+DERIV_LEFT = 6
+DERIV_RIGHT = 7
+
+# holds the best derivations found for each cell of a chart. If allowed is
+# given, it maps cells (row, column) to bitsets of the symbols that may be
+# built there, and everything else is skipped.
+class BestChart(object):
+    def __init__(self, N, costs, flagIndex=-1, allowed=None):
+        self.N = N
+        self.costs = costs
+        self.flagIndex = flagIndex
+        self.allowed = allowed
+        # maps (row, column) to cells; each cell maps (symbol, flag) to a
+        # list with the best (cost, derivation) pair for each cost. Cells
+        # are only created once something is put in them.
+        self.cells = {}
+
+    def __len__(self):
+        return self.N
+
+    # return the flag state of a weight vector
+    def getFlag(self, vec):
+        return self.flagIndex >= 0 and vec[self.flagIndex] > 0
+
+    # offer a derivation for a cost at the given cell, keeping it if it is
+    # the best seen so far
+    def offer(self, row, col, flag, costIndex, deriv):
+        if not(self.allowed == None):
+            if not((self.allowed.get((row, col), 0) >> deriv[DERIV_SYM]) & 1):
+                return
+        key = (deriv[DERIV_SYM], flag)
+        if not((row, col) in self.cells):
+            self.cells[(row, col)] = {}
+        cell = self.cells[(row, col)]
+        if not(key in cell):
+            cell[key] = [None] * len(self.costs)
+        cost = float(np.dot(self.costs[costIndex], deriv[DERIV_VEC]))
+        best = cell[key][costIndex]
+        if best == None or (cost, deriv[DERIV_ORDER]) < (best[0], best[1][DERIV_ORDER]):
+            cell[key][costIndex] = (cost, deriv)
+
+    # offer an inserted derivation under every cost
+    def offerAll(self, row, col, deriv):
+        flag = self.getFlag(deriv[DERIV_VEC])
+        for costIndex in range(len(self.costs)):
+            self.offer(row, col, flag, costIndex, deriv)
+
+# initialize a best chart from the lexicon of a compiled grammar
+def initBestFromLex(chart, tokens, grammar):
+    lex = grammar.lex
+    for i, t in enumerate(tokens):
+        if not(t in lex):
+            raise ValueError("%s not in lexicon" % t)
+        for k, l in enumerate(lex[t]):
+            deriv = ((-1, k), l[0], i, i+1, l[2], l[1], None, None)
+            chart.offerAll(i, i, deriv)
+    return chart
+
+# initialize a best chart from spans. Only spans without children are
+# supported.
+def initBestFromSpans(chart, lexSpans, interiorSpans, grammar):
+    for k, span in enumerate(lexSpans):
+        sym, start, end, mem, weight = span
+        sym = grammar.getSymbolID(sym)
+        if sym < 0:
+            continue
+        deriv = ((-1, k), sym, start, end, mem, weight, None, None)
+        chart.offerAll(start, start, deriv)
+
+    for k, span in enumerate(interiorSpans):
+        if not(len(span) == 5):
+            raise ValueError("Best parse search does not support spans with children")
+        sym, start, end, mem, weight = span
+        sym = grammar.getSymbolID(sym)
+        if sym < 0:
+            continue
+        deriv = ((-1, k), sym, start, end, mem, weight, None, None)
+        chart.offerAll(start, end - 1, deriv)
+    return chart
+
+# run the best parse search upwards on a best chart. If stats is given, the
+# cells, pairs of cell keys, and the symbol and flag states kept in each cell
+# are counted in it (see ParseStats). budget is as for runUpwards.
+def runBestUpwards(chart, grammar, stats=None, budget=None):
+    gramMap = grammar.ruleMap
+    cells = chart.cells
+    numCosts = len(chart.costs)
+    flagIndex = chart.flagIndex
+    allowed = chart.allowed
+    numCreated = 0
+
+    # the cells to fill, narrowest first
+    N = len(chart)
+    if allowed == None:
+        targets = []
+        for i in range(1, N):
+            for j in range(0, N-i):
+                targets.append((j, i + j))
+    else:
+        targets = sorted(allowed.keys(), key=lambda cell: (cell[1] - cell[0], cell[0]))
+
+    for myRow, myCol in targets:
+        i = myCol - myRow
+        if i == 0:
+            continue
+        numKeys = len(cells.get((myRow, myCol), {}))
+        pairsTried = 0
+        pairsMatched = 0
+        for k in range(0, i):
+            left = i - k
+            down = k + 1
+            split = myCol - left + 1
+
+            leftCell = cells.get((myRow, myCol - left))
+            if not(leftCell):
+                continue
+            downCell = cells.get((myRow + down, myCol))
+            if not(downCell):
+                continue
+            pairsTried += len(leftCell) * len(downCell)
+
+            for leftKey in leftCell:
+                b, leftFlag = leftKey
+                if not(b in gramMap):
+                    continue
+                bMap = gramMap[b]
+                leftBests = leftCell[leftKey]
+                for downKey in downCell:
+                    c, downFlag = downKey
+                    if not(c in bMap):
+                        continue
+                    pairsMatched += 1
+                    downBests = downCell[downKey]
+                    for possible in bMap[c]:
+                        pSym, pVec, pMem, ruleIndex = possible
+                        flag = leftFlag or downFlag or (flagIndex >= 0 and pVec[flagIndex] > 0)
+                        for costIndex in range(numCosts):
+                            leftBest = leftBests[costIndex]
+                            downBest = downBests[costIndex]
+                            if leftBest == None or downBest == None:
+                                continue
+                            ld = leftBest[1]
+                            dd = downBest[1]
+                            order = (split, ld[DERIV_ORDER], dd[DERIV_ORDER], ruleIndex)
+                            weightVec = ld[DERIV_VEC] + dd[DERIV_VEC] + pVec
+                            deriv = (order, pSym, myRow, myCol + 1, pMem, weightVec, ld, dd)
+                            chart.offer(myRow, myCol, flag, costIndex, deriv)
+
+        newKeys = len(cells.get((myRow, myCol), {})) - numKeys
+        numCreated += newKeys
+        if not(stats == None):
+            stats.pairsTried += pairsTried
+            stats.pairsMatched += pairsMatched
+            if newKeys > 0:
+                stats.cellsFilled += 1
+                stats.entriesCreated += newKeys
+                stats.cellEntries[(myRow, myCol)] = stats.cellEntries.get((myRow, myCol), 0) + newKeys
+
+        if not(budget == None):
+            budget.check(numCreated)
+
+    return chart
+
+# return the distinct best derivations rooted at one of the root symbol IDs,
+# in the order getParses would return them
+def getBestDerivations(chart, root):
+    N = len(chart)
+    if (N == 0):
+        return []
+
+    found = {}
+    topCell = chart.cells.get((0, N-1), {})
+    for key in topCell:
+        sym, _ = key
+        if sym in root:
+            for best in topCell[key]:
+                if not(best == None):
+                    deriv = best[1]
+                    found[deriv[DERIV_ORDER]] = deriv
+
+    orders = sorted(found.keys())
+    return [found[order] for order in orders]
+
+# build the parse for a derivation
+def getDerivationParse(deriv, grammar):
+    order, a, start, end, mem, wvec, left, right = deriv
+    sym = grammar.getSymbolName(a)
+
+    if left == None:
+        if (end == start + 1):
+            return buildParse(sym, wvec, start, end, mem[0], [])
+        return buildParse(sym, wvec, start, end, [], [])
+
+    leftParse = getDerivationParse(left, grammar)
+    downParse = getDerivationParse(right, grammar)
+    children = getParseChildren(mem, leftParse, downParse)
+    return buildParse(sym, wvec, start, end, mem[0], children)
+
+# extract the best parses from a best chart
+def getBestParses(chart, grammar, root):
+    parses = []
+    for deriv in getBestDerivations(chart, root):
+        parses.append(getDerivationParse(deriv, grammar))
+    return parses
 
 # Print a subparse
 def printSubParse(sp, tab):
@@ -517,36 +1845,164 @@ def printParses(p):
     for entry in p:
         printSubParse(entry, "")
 
-# run full CKY given a list, lexicon, and grammar
-def runFull(tokens, inLex, inGram, root, printPrs=True):
+# run full CKY given a list, lexicon, and grammar. The grammar can be a
+# list of productions or a CompiledGrammar (which carries its own lexicon).
+# If pareto is True, only parses through Pareto-optimal entries are returned
+# (see Chart). If stats is given, counts and timings of the init, upward,
+# filter and extract phases are added to it (see ParseStats). If budget is
+# given, BudgetExceededError is raised if the line runs out of it.
+def runFull(tokens, inLex, inGram, root, printPrs=True, pareto=False, flagIndex=-1, stats=None, budget=None):
+    if stats == None:
+        stats = ParseStats()
+    stats.startPhase()
     N = len(tokens)
-    chart = createEmpty(N)
-    lex, gram = convertGrammarToCNF(inLex, inGram)
-    chart = initFromLex(chart, tokens, lex)
-    chart = runUpwards(chart, gram)
-    chart = filterChart(chart, root)
+    grammar = getCompiledGrammar(inGram, inLex)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = getYieldAllowed(N, getLexSpans(tokens, grammar), grammar, rootIDs)
+    if allowed == None:
+        stats.endPhase("init")
+        return []
+    chart = Chart(N, pareto=pareto, flagIndex=flagIndex)
+    chart = initFromLex(chart, tokens, grammar)
+    stats.endPhase("init")
+    chart = runUpwards(chart, grammar, allowed, stats, budget)
+    stats.endPhase("upward")
+    stats.entriesReachable += int(markReachable(chart, rootIDs).sum())
+    stats.endPhase("filter")
     if (printPrs):
-        printChart(chart)
-    parses = getParses(chart)
+        printChart(chart, grammar)
+    parses = getParses(chart, grammar)
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
 
     if (printPrs):
         printParses(parses)
 
     return parses
 
-# run full CKY given a list of tokens, initialization info for the char, and a grammar
-def runFullCustomInit(tokens, init, inGram, root, printPrs=True):
+# run full CKY given a list of tokens, initialization info for the char, and a grammar.
+# The grammar can be a list of productions or a CompiledGrammar. pareto,
+# flagIndex, stats and budget are as for runFull.
+def runFullCustomInit(tokens, init, inGram, root, printPrs=True, pareto=False, flagIndex=-1, stats=None, budget=None):
+    if stats == None:
+        stats = ParseStats()
+    stats.startPhase()
     N = len(tokens)
-    chart = createEmpty(N)
+    grammar = getCompiledGrammar(inGram)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = getYieldAllowed(N, getInitSpans(init, grammar), grammar, rootIDs)
+    if allowed == None:
+        stats.endPhase("init")
+        return []
+
+    chart = Chart(N, pareto=pareto, flagIndex=flagIndex)
+    chart = initFromSpans(chart, init[0], init[1], grammar)
+    stats.endPhase("init")
+    chart = runUpwards(chart, grammar, allowed, stats, budget)
+    stats.endPhase("upward")
+    stats.entriesReachable += int(markReachable(chart, rootIDs).sum())
+    stats.endPhase("filter")
+    if (printPrs):
+        printChart(chart, grammar)
+    parses = getParses(chart, grammar)
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
 
-    inLex = {}
-    lex, gram = convertGrammarToCNF(inLex, inGram)
-    chart = initFromSpans(chart, init[0], init[1])
-    chart = runUpwards(chart, gram)
-    chart = filterChart(chart, root)
     if (printPrs):
-        printChart(chart)
-    parses = getParses(chart)
+        printParses(parses)
+
+    return parses
+
+# build the parse forest for a list of tokens given a lexicon and grammar
+def runForest(tokens, inLex, inGram, root):
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram, inLex)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = getYieldAllowed(N, getLexSpans(tokens, grammar), grammar, rootIDs)
+    if allowed == None:
+        return ParseForest(grammar)
+    chart = Chart(N)
+    chart = initFromLex(chart, tokens, grammar)
+    chart = runUpwards(chart, grammar, allowed)
+    markReachable(chart, rootIDs)
+    return buildForest(chart, grammar, rootIDs)
+
+# build the parse forest for a list of tokens given initialization info for
+# the chart and a grammar
+def runForestCustomInit(tokens, init, inGram, root):
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = getYieldAllowed(N, getInitSpans(init, grammar), grammar, rootIDs)
+    if allowed == None:
+        return ParseForest(grammar)
+    chart = Chart(N)
+    chart = initFromSpans(chart, init[0], init[1], grammar)
+    chart = runUpwards(chart, grammar, allowed)
+    markReachable(chart, rootIDs)
+    return buildForest(chart, grammar, rootIDs)
+
+# run the best parse search given a list of tokens, a lexicon, and a grammar.
+# Returns the distinct best parses under each cost (see BestChart), in the
+# order runFull would list them. stats is as for runFull, with no filter
+# phase, and so is budget.
+def runBest(tokens, inLex, inGram, root, costs, flagIndex=-1, printPrs=False, stats=None, budget=None):
+    if stats == None:
+        stats = ParseStats()
+    stats.startPhase()
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram, inLex)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = getYieldAllowed(N, getLexSpans(tokens, grammar), grammar, rootIDs)
+    if allowed == None:
+        stats.endPhase("init")
+        return []
+    chart = BestChart(N, costs, flagIndex, allowed)
+    chart = initBestFromLex(chart, tokens, grammar)
+    stats.endPhase("init")
+    chart = runBestUpwards(chart, grammar, stats, budget)
+    stats.endPhase("upward")
+    parses = getBestParses(chart, grammar, rootIDs)
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
+
+    if (printPrs):
+        printParses(parses)
+
+    return parses
+
+# run the best parse search given a list of tokens, initialization info for
+# the chart, and a grammar. Returns the distinct best parses under each cost
+# (see BestChart), in the order runFullCustomInit would list them. allowed
+# optionally restricts the symbols built in each cell (see BestChart)
+# further than the yields of the symbols do. stats and budget are as for
+# runBest.
+def runBestCustomInit(tokens, init, inGram, root, costs, flagIndex=-1, printPrs=False, allowed=None, stats=None, budget=None):
+    if stats == None:
+        stats = ParseStats()
+    stats.startPhase()
+    N = len(tokens)
+    grammar = getCompiledGrammar(inGram)
+    rootIDs = grammar.getSymbolIDs(root)
+    yieldAllowed = getYieldAllowed(N, getInitSpans(init, grammar), grammar, rootIDs)
+    if yieldAllowed == None:
+        stats.endPhase("init")
+        return []
+    if not(allowed == None):
+        for cell in list(yieldAllowed.keys()):
+            mask = yieldAllowed[cell] & allowed.get(cell, 0)
+            if mask:
+                yieldAllowed[cell] = mask
+            else:
+                del yieldAllowed[cell]
+    chart = BestChart(N, costs, flagIndex, yieldAllowed)
+    chart = initBestFromSpans(chart, init[0], init[1], grammar)
+    stats.endPhase("init")
+    chart = runBestUpwards(chart, grammar, stats, budget)
+    stats.endPhase("upward")
+    parses = getBestParses(chart, grammar, rootIDs)
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
 
     if (printPrs):
         printParses(parses)
@@ -0,0 +1,223 @@
+# Top-down predictive parsing of lattices of spans with an agenda, as an
+# alternative to the bottom-up CKY in CKY.py. Entries are only built for
+# symbols that some derivation from the root symbols predicts at their start
+# position, so constituents that cannot fit into a line where they are, such
+# as feet that would start in the middle of another foot, are never built.
+# The parser fills the same packed chart as CKY (see CKY.Chart), so parses
+# are extracted from it in the same way and come out in the same order.
+import odikon.CKY as CKY
+
+import numpy as np
+
+# ===========================================================================
+# ============================= Agenda Parsing ==============================
+# ===========================================================================
+
+# The parser works through the positions of the lattice from left to right.
+# At each position it first completes the entries ending there, in the order
+# they are found, and then scans the spans starting there whose symbols are
+# predicted at it. Symbols are predicted at a position when a rule's left
+# child ends there and its parent was predicted where the left child began;
+# the rule's down child then has to start there, and so do the symbols that
+# can begin it (see CompiledGrammar.getLeftCornerMasks).
+#
+# Items waiting at a position for their down child are tuples of
+# (rule, start, left)
+# where rule is a grammar rule as stored in CompiledGrammar.ruleMap, start
+# is where the rule's parent begins, and left is the arena index of the
+# entry for its left child, which ends at the position.
+
+# fill a chart that only holds the entries inserted into it, building the
+# entries that can be reached from the root symbols. rootIDs is a list of
+# root symbol IDs. If allowed is given, it maps cells to the symbols that
+# may be built in them as for CKY.runUpwards.
+#
+# If stats is given (see CKY.ParseStats), the cells filled and entries built
+# are counted as CKY.runUpwards counts them. The parser only ever pairs a
+# left and a down entry through a rule that joins them, so each pair it
+# tries is one of a waiting item and a completed entry, and it is matched
+# if its parent may be built in its cell. If budget is given (see
+# CKY.ParseBudget), it is checked after each position, counting the entries
+# built.
+def runAgenda(chart, grammar, rootIDs, allowed=None, stats=None, budget=None):
+    N = len(chart)
+    gramMap = grammar.ruleMap
+    leftCorners = grammar.getLeftCornerMasks()
+    entries = chart.entries
+    numInserted = len(entries)
+    if stats == None:
+        stats = CKY.ParseStats()
+
+    # bitsets of the symbols predicted at each position, the items waiting
+    # at each position by the symbol they wait for, and the entries ending
+    # at each position that are still to be completed
+    predicted = [0] * (N + 1)
+    waiting = []
+    pending = []
+    for _ in range(N + 1):
+        waiting.append({})
+        pending.append([])
+
+    # the inserted entries, by where they start
+    inserted = []
+    for _ in range(N + 1):
+        inserted.append([])
+    for index, entry in enumerate(entries):
+        inserted[entry[CKY.ENTRY_START]].append(index)
+
+    for sym in rootIDs:
+        predicted[0] |= leftCorners[sym]
+
+    for pos in range(N + 1):
+        # complete the entries ending here. Entries built here end here too,
+        # so they are added to the agenda as it is worked through.
+        agenda = pending[pos]
+        numEntries = len(entries)
+        pairsTried = 0
+        pairsMatched = 0
+        cellEntries = {}
+        i = 0
+        while i < len(agenda):
+            index = agenda[i]
+            i += 1
+            sym, start, _, vec, _ = entries[index]
+
+            # build the parents of the items waiting for this symbol
+            for item in waiting[start].get(sym, []):
+                rule, itemStart, leftIndex = item
+                pSym, pVec, pMem, pRule = rule
+                pairsTried += 1
+                if not(allowed == None):
+                    if not((allowed.get((itemStart, pos - 1), 0) >> pSym) & 1):
+                        continue
+                pairsMatched += 1
+                weightVec = entries[leftIndex][CKY.ENTRY_VEC] + vec + pVec
+                back = (start, leftIndex, index, pRule, pMem)
+                numBuilt = len(entries)
+                parent = chart.addDerivation(itemStart, pos - 1, pSym, weightVec, back)
+                if parent == numBuilt:
+                    agenda.append(parent)
+                    cellKey = (itemStart, pos - 1)
+                    cellEntries[cellKey] = cellEntries.get(cellKey, 0) + 1
+
+            # start the rules this symbol is the left child of, if their
+            # parents were predicted where it begins
+            if not(sym in gramMap):
+                continue
+            bMap = gramMap[sym]
+            for c in bMap:
+                for rule in bMap[c]:
+                    if not((predicted[start] >> rule[0]) & 1):
+                        continue
+                    if not(c in waiting[pos]):
+                        waiting[pos][c] = []
+                    waiting[pos][c].append((rule, start, index))
+                    predicted[pos] |= leftCorners[c]
+
+        stats.pairsTried += pairsTried
+        stats.pairsMatched += pairsMatched
+        stats.cellsFilled += len(cellEntries)
+        stats.entriesCreated += len(entries) - numEntries
+        for cellKey in cellEntries:
+            stats.cellEntries[cellKey] = stats.cellEntries.get(cellKey, 0) + cellEntries[cellKey]
+        if not(budget == None):
+            budget.check(len(entries) - numInserted)
+
+        if pos == N:
+            break
+
+        # everything predicted here is known, so scan the spans starting here
+        for index in inserted[pos]:
+            sym, _, end, _, _ = entries[index]
+            if (predicted[pos] >> sym) & 1:
+                pending[end].append(index)
+
+    return chart
+
+# prune a chart filled by runAgenda the way CKY.runUpwards prunes a chart as
+# it fills it (see CKY.Chart). Entries are built out of order here, so the
+# first derivation of each entry is found among all of its derivations once
+# the chart is full. Cells are pruned from the shortest spans up, first
+# dropping the derivations through entries pruned below them. allowed is as
+# for runAgenda; CKY.runUpwards never visits, and so never prunes, cells
+# that it leaves out.
+def pruneChart(chart, allowed=None):
+    N = len(chart)
+    entries = chart.entries
+    chart.firstOrders = [None] * len(entries)
+    dropped = np.zeros(len(entries), dtype=bool)
+
+    for i in range(0, N):
+        for j in range(0, N-i):
+            row = j
+            col = i + j
+            cell = chart.getCell(row, col)
+
+            kept = []
+            for index in cell:
+                backs = chart.entries[index][CKY.ENTRY_BACKS]
+                liveBacks = []
+                for back in backs:
+                    split, lid, did, _, _ = back
+                    if split < 0 or not(dropped[lid] or dropped[did]):
+                        liveBacks.append(back)
+                backs[:] = liveBacks
+                if len(backs) == 0:
+                    dropped[index] = True
+                    continue
+                orders = [chart.getBackOrder(back) for back in backs]
+                chart.firstOrders[index] = min(orders)
+                kept.append(index)
+
+            if len(kept) < len(cell):
+                chart.setCell(row, col, kept)
+                symbolCell = chart.symbolCells[CKY.getCellIndex(N, row, col)]
+                for sym in symbolCell:
+                    symbolCell[sym] = [index for index in symbolCell[sym] if not(dropped[index])]
+
+            if i == 0:
+                continue
+            if not(allowed == None) and not((row, col) in allowed):
+                continue
+            CKY.pruneCell(chart, row, col)
+            if len(chart.getCell(row, col)) < len(kept):
+                for index in set(kept).difference(chart.getCell(row, col)):
+                    dropped[index] = True
+
+    return chart
+
+# run the agenda parser given a list of tokens, initialization info for the
+# chart, and a grammar, with the same arguments and results as
+# CKY.runFullCustomInit. stats and budget are as for runAgenda.
+def runFullCustomInit(tokens, init, inGram, root, printPrs=True, pareto=False, flagIndex=-1, stats=None, budget=None):
+    if stats == None:
+        stats = CKY.ParseStats()
+    stats.startPhase()
+    N = len(tokens)
+    grammar = CKY.getCompiledGrammar(inGram)
+    rootIDs = grammar.getSymbolIDs(root)
+    allowed = CKY.getYieldAllowed(N, CKY.getInitSpans(init, grammar), grammar, rootIDs)
+    if allowed == None:
+        stats.endPhase("init")
+        return []
+
+    chart = CKY.Chart(N, flagIndex=flagIndex)
+    chart = CKY.initFromSpans(chart, init[0], init[1], grammar)
+    stats.endPhase("init")
+    chart = runAgenda(chart, grammar, rootIDs, allowed, stats, budget)
+    stats.endPhase("agenda")
+    if pareto:
+        chart = pruneChart(chart, allowed)
+        stats.endPhase("prune")
+    stats.entriesReachable += int(CKY.markReachable(chart, rootIDs).sum())
+    stats.endPhase("filter")
+    if (printPrs):
+        CKY.printChart(chart, grammar)
+    parses = CKY.getParses(chart, grammar)
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
+
+    if (printPrs):
+        CKY.printParses(parses)
+
+    return parses
@@ -0,0 +1,478 @@
+# Compilation of non-recursive grammars to weighted finite-state automata,
+# and best path search over a lattice of spans with them. Meter grammars only
+# describe finite patterns of syllables, so a line can be scanned in time
+# linear in the size of its lattice rather than with a cubic CKY chart.
+import odikon.CKY as CKY
+
+# ===========================================================================
+# ========================= Automaton Compilation ===========================
+# ===========================================================================
+
+# The automaton is built from the CNF form of a grammar (see
+# CKY.CompiledGrammar) by unrolling every way of expanding the root symbols,
+# so each path through it spells out a whole derivation. Arcs are tuples of
+# (kind, target state, value)
+# A span arc consumes a span of the lattice whose symbol is the arc's value.
+# The other arcs consume nothing and record the structure of the derivation:
+# an open arc starts a node built with the rule given by its value, a split
+# arc ends the left child of the innermost open node, and a close arc ends
+# the innermost open node.
+ARC_SPAN = 0
+ARC_OPEN = 1
+ARC_SPLIT = 2
+ARC_CLOSE = 3
+
+ARC_KIND = 0
+ARC_TARGET = 1
+ARC_VALUE = 2
+
+# holds a weighted finite-state automaton for a grammar. Each state also
+# records how many nodes are open above it whose left child has not ended
+# yet; see runBestDown for why this is needed.
+class Automaton(object):
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.arcs = []
+        self.depths = []
+        self.start = self.addState(0)
+        self.final = self.addState(0)
+        # maps root symbol IDs to their own start states, when the roots are
+        # kept apart (see compileAutomaton)
+        self.rootStarts = {}
+        # the costs and flags of the grammar's rules, by the costs and flag
+        # index they were worked out for (see getRuleSteps)
+        self.ruleSteps = {}
+        # states in an order where every arc goes to a later state
+        self.order = []
+
+    def __len__(self):
+        return len(self.arcs)
+
+    # add a state, returning its index
+    def addState(self, depth):
+        self.arcs.append([])
+        self.depths.append(depth)
+        return len(self.arcs) - 1
+
+    # add an arc between two states
+    def addArc(self, source, kind, target, value):
+        self.arcs[source].append((kind, target, value))
+
+# add the paths for every expansion of a symbol between two states.
+# Raises a ValueError if the symbol can be expanded into itself.
+def addSymbolPaths(automaton, rulesBySym, sym, source, target, depth, stack):
+    if sym in stack:
+        raise ValueError("Grammar is recursive in %s" % automaton.grammar.getSymbolName(sym))
+
+    # the symbol can always come straight from a span
+    automaton.addArc(source, ARC_SPAN, target, sym)
+
+    stack = stack + [sym]
+    for ruleIndex in rulesBySym.get(sym, []):
+        _, b, c, _, _ = automaton.grammar.rules[ruleIndex]
+        leftStart = automaton.addState(depth + 1)
+        leftEnd = automaton.addState(depth + 1)
+        downStart = automaton.addState(depth)
+        downEnd = automaton.addState(depth)
+
+        automaton.addArc(source, ARC_OPEN, leftStart, ruleIndex)
+        addSymbolPaths(automaton, rulesBySym, b, leftStart, leftEnd, depth + 1, stack)
+        automaton.addArc(leftEnd, ARC_SPLIT, downStart, None)
+        addSymbolPaths(automaton, rulesBySym, c, downStart, downEnd, depth, stack)
+        automaton.addArc(downEnd, ARC_CLOSE, target, ruleIndex)
+
+# return the states of an automaton in an order where every arc goes to a
+# later state
+def getStateOrder(automaton):
+    visited = [False] * len(automaton)
+    order = []
+    # iterative depth first search, recording states once all of their
+    # targets are done
+    for first in range(len(automaton)):
+        if visited[first]:
+            continue
+        visited[first] = True
+        stack = [(first, 0)]
+        while len(stack) > 0:
+            state, arcIndex = stack[-1]
+            arcs = automaton.arcs[state]
+            if arcIndex < len(arcs):
+                stack[-1] = (state, arcIndex + 1)
+                target = arcs[arcIndex][ARC_TARGET]
+                if not(visited[target]):
+                    visited[target] = True
+                    stack.append((target, 0))
+            else:
+                stack.pop()
+                order.append(state)
+    order.reverse()
+    return order
+
+# compile a grammar with the given root symbols to an automaton. The grammar
+# can be a list of productions or a CKY.CompiledGrammar. If separateRoots is
+# True, the paths of each root begin at a start state of their own instead
+# of the shared one, so the best paths for every root can be found in one
+# search (see runBestPerRootCustomInit). Raises a ValueError if the grammar
+# is recursive, in which case it has to be parsed with CKY.
+def compileAutomaton(inGram, root, separateRoots=False):
+    grammar = CKY.getCompiledGrammar(inGram)
+    automaton = Automaton(grammar)
+
+    rulesBySym = {}
+    for ruleIndex, rule in enumerate(grammar.rules):
+        if not(rule[0] in rulesBySym):
+            rulesBySym[rule[0]] = []
+        rulesBySym[rule[0]].append(ruleIndex)
+
+    for sym in grammar.getSymbolIDs(root):
+        start = automaton.start
+        if separateRoots:
+            start = automaton.addState(0)
+            automaton.rootStarts[sym] = start
+        addSymbolPaths(automaton, rulesBySym, sym, start, automaton.final, 0, [])
+
+    automaton.order = getStateOrder(automaton)
+    return automaton
+
+
+# ===========================================================================
+# ============================ Best Path Search =============================
+# ===========================================================================
+
+# A lattice maps each position to a map from symbols to the spans starting
+# there. Spans are tuples of
+# (end, order, memory, weight vector, is lexical)
+# where order is the order tokens of the chart entry the span would become
+# (see below).
+LAT_END = 0
+LAT_ORDER = 1
+LAT_MEM = 2
+LAT_VEC = 3
+LAT_LEX = 4
+
+# Ties between paths of equal cost are broken the same way the CKY best
+# parse search breaks them (see CKY.BestChart), by the order CKY.getParses
+# would return their derivations in. That order compares nested tuples of
+# (split, left order, down order, rule index); here it is flattened into a
+# sequence of tokens, with every nested tuple between ORDER_OPEN and
+# ORDER_CLOSE. ORDER_CLOSE is below every other token, just as a tuple is
+# below any longer tuple it starts.
+ORDER_CLOSE = -3
+ORDER_OPEN = -2
+
+# build the lattice for spans given in the same form as for
+# CKY.runFullCustomInit. Only spans without children are supported.
+def buildLattice(lexSpans, interiorSpans, grammar):
+    lattice = {}
+    for isLex, spans in [(True, lexSpans), (False, interiorSpans)]:
+        for k, span in enumerate(spans):
+            if not(len(span) == 5):
+                raise ValueError("Best path search does not support spans with children")
+            sym, start, end, mem, weight = span
+            sym = grammar.getSymbolID(sym)
+            if sym < 0:
+                continue
+            if not(start in lattice):
+                lattice[start] = {}
+            if not(sym in lattice[start]):
+                lattice[start][sym] = []
+            order = (ORDER_OPEN, -1, k, ORDER_CLOSE)
+            lattice[start][sym].append((end, order, mem, weight, isLex))
+    return lattice
+
+# return the positions from which each state can be reached from the start
+# states at position 0, as a list of sets
+def getReachable(automaton, lattice):
+    reachable = [set() for _ in range(len(automaton))]
+    reachable[automaton.start].add(0)
+    for sym in automaton.rootStarts:
+        reachable[automaton.rootStarts[sym]].add(0)
+    for state in automaton.order:
+        positions = reachable[state]
+        if len(positions) == 0:
+            continue
+        for kind, target, value in automaton.arcs[state]:
+            if kind == ARC_SPAN:
+                for position in positions:
+                    for span in lattice.get(position, {}).get(value, []):
+                        reachable[target].add(span[LAT_END])
+            else:
+                reachable[target] |= positions
+    return reachable
+
+# return whether each state can lead to the final state at position N from
+# some position it is reached at, as a list of booleans. This is worked out
+# for states rather than for each of their positions, so it is cheap; it is
+# enough to skip the states of roots that cannot end the line, such as those
+# of meters the line does not scan in.
+def getLive(automaton, lattice, N, reachable):
+    live = [False] * len(automaton)
+    for state in reversed(automaton.order):
+        positions = reachable[state]
+        if len(positions) == 0:
+            continue
+        for kind, target, value in automaton.arcs[state]:
+            if not(target == automaton.final):
+                if live[target]:
+                    live[state] = True
+                    break
+            elif kind == ARC_SPAN:
+                for position in positions:
+                    for span in lattice.get(position, {}).get(value, []):
+                        if span[LAT_END] == N:
+                            live[state] = True
+                if live[state]:
+                    break
+            elif N in positions:
+                live[state] = True
+                break
+    return live
+
+# return the costs and flag of each rule of an automaton's grammar, as a
+# pair of lists. They are the same for every line, so they are only worked
+# out once for each set of costs.
+def getRuleSteps(automaton, costs, flagIndex):
+    key = (tuple([tuple(cost) for cost in costs]), flagIndex)
+    if not(key in automaton.ruleSteps):
+        ruleCosts = []
+        ruleFlags = []
+        for rule in automaton.grammar.rules:
+            vec = rule[3]
+            ruleCosts.append([float(cost.dot(vec)) for cost in costs])
+            ruleFlags.append(bool(flagIndex >= 0 and vec[flagIndex] > 0))
+        automaton.ruleSteps[key] = (ruleCosts, ruleFlags)
+    return automaton.ruleSteps[key]
+
+# Run the best path search backwards from the final state at position N. For
+# each state and position, and for each cost and flag state, this keeps the
+# best way of finishing the line from there, as a tuple of
+# (cost, order, flag, arc, span, next position)
+# where order is the tokens of the rest of the path.
+#
+# An open arc is followed by the split of its node, which is only known once
+# the left child ends, further along the path. So the order kept for a state
+# starts with the splits of the nodes open above it whose left child has not
+# ended, and every arc puts its own tokens after those. That way comparing
+# the orders of two ways of finishing from the same state compares them the
+# way they would compare in the whole path.
+#
+# If stats is given, the spans in the lattice, the (state, position) pairs
+# kept and the arcs tried and kept are added to it as the search goes (see
+# CKY.ParseStats). If budget is given (see CKY.ParseBudget), it is checked
+# after each state, counting the (state, position) pairs kept, so the
+# statesKept of a line that runs out of it is the amount it ran out at.
+def runBestDown(automaton, lattice, N, costs, flagIndex=-1, budget=None, stats=None):
+    if stats == None:
+        stats = CKY.ParseStats()
+    grammar = automaton.grammar
+    numCosts = len(costs)
+    reachable = getReachable(automaton, lattice)
+
+    best = {}
+    for position in lattice:
+        for sym in lattice[position]:
+            stats.latticeSpans += len(lattice[position][sym])
+    if not(N in reachable[automaton.final]):
+        return best
+
+    final = [[None, None] for _ in range(numCosts)]
+    for costIndex in range(numCosts):
+        final[costIndex][0] = (0.0, (), False, None, None, None)
+    best[(N, automaton.final)] = final
+
+    # the costs and flag of each rule and span
+    ruleCosts, ruleFlags = getRuleSteps(automaton, costs, flagIndex)
+    spanSteps = {}
+    for position in lattice:
+        spanSteps[position] = {}
+        for sym in lattice[position]:
+            spanSteps[position][sym] = []
+            for span in lattice[position][sym]:
+                vec = span[LAT_VEC]
+                spanCosts = [float(cost.dot(vec)) for cost in costs]
+                spanFlag = bool(flagIndex >= 0 and vec[flagIndex] > 0)
+                spanSteps[position][sym].append((span, spanCosts, spanFlag))
+    noCosts = [0.0] * numCosts
+    live = getLive(automaton, lattice, N, reachable)
+    stats.statesKept += len(best)
+
+    for state in reversed(automaton.order):
+        if not(live[state]):
+            continue
+        depth = automaton.depths[state]
+        for position in sorted(reachable[state], reverse=True):
+            # each step to a next state, as a tuple of
+            # (arc, span, next position, next bests, costs, flag, tokens, index)
+            # where the tokens of the step go at index in the next order
+            steps = []
+            arcsTried = 0
+            for arc in automaton.arcs[state]:
+                kind, target, value = arc
+                if kind == ARC_SPAN:
+                    for span, spanCosts, spanFlag in spanSteps.get(position, {}).get(value, []):
+                        arcsTried += 1
+                        nextBest = best.get((span[LAT_END], target))
+                        if not(nextBest == None):
+                            steps.append((arc, span, span[LAT_END], nextBest, spanCosts,
+                                          spanFlag, span[LAT_ORDER], depth))
+                    continue
+
+                arcsTried += 1
+                nextBest = best.get((position, target))
+                if nextBest == None:
+                    continue
+                if kind == ARC_OPEN:
+                    steps.append((arc, None, position, nextBest, noCosts, False,
+                                  (ORDER_OPEN,), depth))
+                elif kind == ARC_SPLIT:
+                    # the split this arc makes known was pending here, but
+                    # isn't any more at the next state
+                    steps.append((arc, None, position, nextBest, noCosts, False,
+                                  (position,), depth - 1))
+                else:
+                    steps.append((arc, None, position, nextBest, ruleCosts[value],
+                                  ruleFlags[value], (value, ORDER_CLOSE), depth))
+
+            stats.arcsTried += arcsTried
+            if len(steps) == 0:
+                continue
+            stats.arcsKept += len(steps)
+            stats.statesKept += 1
+
+            bests = [[None, None] for _ in range(numCosts)]
+            for arc, span, nextPosition, nextBest, stepCosts, stepFlag, tokens, index in steps:
+                for costIndex in range(numCosts):
+                    for nextFlag in [False, True]:
+                        nextPath = nextBest[costIndex][nextFlag]
+                        if nextPath == None:
+                            continue
+                        nextCost, nextOrder, _, _, _, _ = nextPath
+                        cost = stepCosts[costIndex] + nextCost
+                        order = nextOrder[:index] + tokens + nextOrder[index:]
+                        flag = stepFlag or nextFlag
+                        current = bests[costIndex][flag]
+                        if current == None or (cost, order) < (current[0], current[1]):
+                            bests[costIndex][flag] = (cost, order, nextFlag, arc, span, nextPosition)
+            best[(position, state)] = bests
+
+        if not(budget == None):
+            budget.check(len(best))
+
+    return best
+
+# build the parse for the best path under a cost with the given flag state
+# from a start state (the shared one if not given), from the results of
+# runBestDown
+def getPathParse(automaton, best, costIndex, flag, start=None):
+    grammar = automaton.grammar
+    state = start
+    if state == None:
+        state = automaton.start
+    position = 0
+
+    # nodes open on the path, as lists of [rule index, start, children]
+    stack = [[None, 0, []]]
+    while not(state == automaton.final):
+        path = best[(position, state)][costIndex][flag]
+        _, _, flag, arc, span, nextPosition = path
+        kind, target, value = arc
+
+        if kind == ARC_SPAN:
+            end, _, mem, vec, isLex = span
+            sym = grammar.getSymbolName(value)
+            unitChain = mem[0] if isLex else []
+            parse = CKY.buildParse(sym, vec, position, end, unitChain, [])
+            stack[-1][2].append(parse)
+        elif kind == ARC_OPEN:
+            stack.append([value, position, []])
+        elif kind == ARC_CLOSE:
+            ruleIndex, start, children = stack.pop()
+            a, _, _, pVec, pMem = grammar.rules[ruleIndex]
+            leftParse, downParse = children
+            weightVec = leftParse["vec"] + downParse["vec"] + pVec
+            sym = grammar.getSymbolName(a)
+            children = CKY.getParseChildren(pMem, leftParse, downParse)
+            parse = CKY.buildParse(sym, weightVec, start, position, pMem[0], children)
+            stack[-1][2].append(parse)
+
+        state = target
+        position = nextPosition
+
+    return stack[0][2][0]
+
+# return the distinct best parses under each cost, in the order
+# CKY.runFullCustomInit would list them. This gives the same parses as
+# CKY.runBestCustomInit. start is as for getPathParse.
+def getBestParses(automaton, best, numCosts, start=None):
+    if start == None:
+        start = automaton.start
+    found = {}
+    startBest = best.get((0, start))
+    if startBest == None:
+        return []
+
+    for costIndex in range(numCosts):
+        for flag in [False, True]:
+            path = startBest[costIndex][flag]
+            if not(path == None) and not(path[1] in found):
+                found[path[1]] = getPathParse(automaton, best, costIndex, flag, start)
+
+    return [found[order] for order in sorted(found.keys())]
+
+# run the best path search given a list of tokens, initialization info for
+# the lattice in the same form as for CKY.runFullCustomInit, and an automaton
+# from compileAutomaton. If stats is given, the timings of the init, search
+# and extract phases and the parses found are added to it (see
+# CKY.ParseStats), along with the work of the search (see runBestDown). If
+# budget is given, CKY.BudgetExceededError is raised if the line runs out of
+# it.
+def runBestCustomInit(tokens, init, automaton, costs, flagIndex=-1, printPrs=False, stats=None, budget=None):
+    if stats == None:
+        stats = CKY.ParseStats()
+    stats.startPhase()
+    N = len(tokens)
+    if N == 0:
+        stats.endPhase("init")
+        return []
+
+    lattice = buildLattice(init[0], init[1], automaton.grammar)
+    stats.endPhase("init")
+    best = runBestDown(automaton, lattice, N, costs, flagIndex, budget, stats)
+    stats.endPhase("search")
+    parses = getBestParses(automaton, best, len(costs))
+    stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
+
+    if (printPrs):
+        CKY.printParses(parses)
+
+    return parses
+
+# run the best path search once for an automaton compiled with separateRoots,
+# returning the distinct best parses under each cost for every root symbol,
+# as a map from root symbol names to lists of parses like those
+# runBestCustomInit returns. stats and budget are as for runBestCustomInit.
+def runBestPerRootCustomInit(tokens, init, automaton, costs, flagIndex=-1, stats=None, budget=None):
+    if stats == None:
+        stats = CKY.ParseStats()
+    stats.startPhase()
+    grammar = automaton.grammar
+    results = {}
+    for sym in automaton.rootStarts:
+        results[grammar.getSymbolName(sym)] = []
+    N = len(tokens)
+    if N == 0:
+        stats.endPhase("init")
+        return results
+
+    lattice = buildLattice(init[0], init[1], grammar)
+    stats.endPhase("init")
+    best = runBestDown(automaton, lattice, N, costs, flagIndex, budget, stats)
+    stats.endPhase("search")
+    for sym in automaton.rootStarts:
+        parses = getBestParses(automaton, best, len(costs), automaton.rootStarts[sym])
+        results[grammar.getSymbolName(sym)] = parses
+        stats.parsesExtracted += len(parses)
+    stats.endPhase("extract")
+
+    return results
@@ -3,9 +3,71 @@ import odikon.scan as scanner
 import numpy as np
 
 
-# given a line and a meter, attempt to scan that line
-def scanLine(line, meter):
-    return scanner.scanLine(line, meter)
+# given a line and a meter, attempt to scan that line. If stats is given
+# (from newScanStats), counts and timings for the line are added to it. If
+# budget is given (from newScanBudget) and the line runs out of it, the
+# result is a BudgetExceeded holding the line's statistics so far instead of
+# a scansion.
+def scanLine(line, meter, stats=None, budget=None):
+    return scanner.scanLine(line, meter, stats=stats, budget=budget)
+
+# return an empty statistics object to pass to scanLine
+def newScanStats():
+    return scanner.CKY.ParseStats()
+
+# return a budget limiting the entries built and the seconds spent on each
+# line scanned with it; either can be None for no limit. Lines whose scansion
+# is already in the lattice cache are only held to the time limit.
+def newScanBudget(maxEntries=None, maxSeconds=None):
+    return scanner.CKY.ParseBudget(maxEntries, maxSeconds)
+
+# return true if a result from scanLine or scanLines ran out of its budget
+def isBudgetExceeded(result):
+    return scanner.isBudgetExceeded(result)
+
+# given a list of lines, such as those of a book, and a meter, scan every
+# line and return counts and timings across all of them. Call getReport()
+# on the result for a summary that includes the slowest lines.
+def getScanStats(lines, meter):
+    return scanner.getScanStats(lines, meter)
+
+# return the hits, misses and evictions of the cache of per-word syllable
+# spans shared by every scan, along with its size and hit rate, as a dict
+def getSpanCacheStats():
+    return scanner.getSpanCacheStats()
+
+# empty the cache of per-word syllable spans and reset its counters
+def clearSpanCache():
+    scanner.clearSpanCache()
+
+# return the hits, misses and evictions of the cache of best parses by
+# lattice of spans, along with its size and hit rate, as a dict
+def getLatticeCacheStats():
+    return scanner.getLatticeCacheStats()
+
+# empty the cache of best parses by lattice of spans and reset its counters
+def clearLatticeCache():
+    scanner.clearLatticeCache()
+
+# given a list of lines and a meter, attempt to scan every line, returning
+# a list of the best scansion for each, the same as calling scanLine on each
+# line. budget is as for scanLine, applying to each line separately.
+def scanLines(lines, meter, budget=None):
+    return scanner.scanLines(lines, meter, budget=budget)
+
+# given a line and a meter, return true if the line scans in that meter
+def lineScans(line, meter):
+    return scanner.lineScans(line, meter)
+
+# given a line, scan it in every meter at once, returning a map from each
+# meter to its best scansion, or None where the line doesn't scan
+def scanLineAllMeters(line):
+    return scanner.scanLineMeters(line)
+
+# given a line and a meter, return up to k of the best scansions of that
+# line, best first
+def scanLineKBest(line, meter, k):
+    return scanner.scanLineKBest(line, meter, k)
 
 # return true if this line should be skipped because it is just an exclamation
 def skipLine(line):
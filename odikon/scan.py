@@ -1,8 +1,11 @@
 # contains utilities for scanning
+import itertools
 import re
+import time
 
 import odikon.utils as utils
 import odikon.CKY as CKY
+import odikon.FSA as FSA
 
 import numpy as np
 
@@ -107,11 +110,73 @@ anapestGrammar = [
     (SYM.ANAP_P, [SYM.SHORT, SYM.SHORT, SYM.LONG, SYM.LONG], getFeatureArr()),
 ]
 
+# compiled grammars for each meter; each is converted to CNF the first
+# time it is used and reused afterwards
 meterGrammars = {
-    "IAMBS": iambGrammar,
-    "ANAPESTS": anapestGrammar
+    "IAMBS": CKY.CompiledGrammar(iambGrammar),
+    "ANAPESTS": CKY.CompiledGrammar(anapestGrammar)
 }
 
+# automata for each meter, compiled from its grammar the first time they
+# are needed. None for meters whose grammars are recursive, which have to be
+# scanned with CKY.
+meterAutomata = {}
+
+# return the automaton for a meter, or None if it has to be scanned with CKY
+def getMeterAutomaton(meter):
+    if not(meter in meterAutomata):
+        try:
+            meterAutomata[meter] = FSA.compileAutomaton(meterGrammars[meter], [SYM.LINE])
+        except ValueError:
+            meterAutomata[meter] = None
+    return meterAutomata[meter]
+
+# Meters can also be scanned all at once, with a union of their grammars
+# that has a root for each meter. The symbols each meter's grammar builds are
+# renamed apart, as "METER:SYMBOL", while the span symbols they are built
+# from are shared, so a line's lattice of spans is searched only once
+# however many meters there are.
+UNION_SEPARATOR = ":"
+
+# return the name a meter's symbol has in the union grammar
+def getUnionSymbol(meter, sym):
+    return meter + UNION_SEPARATOR + sym
+
+# build the union grammar of a list of meters, returning its productions and
+# a map from its symbols back to their names in the meters' own grammars
+def getUnionGrammar(meters):
+    gram = []
+    names = {}
+    for meter in meters:
+        rawGram = meterGrammars[meter].rawGram
+        built = set([prod[0] for prod in rawGram])
+        for sym in built:
+            names[getUnionSymbol(meter, sym)] = sym
+
+        for a, children, vec in rawGram:
+            children = [getUnionSymbol(meter, c) if c in built else c for c in children]
+            gram.append((getUnionSymbol(meter, a), children, vec))
+    return gram, names
+
+# union automata for tuples of meters, as pairs of the automaton and the
+# symbol names from getUnionGrammar, built the first time they are needed.
+# None if any of the meters' grammars is recursive.
+unionAutomata = {}
+
+# return the union automaton and symbol names for a list of meters, or None
+# if they have to be scanned one at a time
+def getUnionAutomaton(meters):
+    key = tuple(meters)
+    if not(key in unionAutomata):
+        gram, names = getUnionGrammar(meters)
+        roots = [getUnionSymbol(meter, SYM.LINE) for meter in meters]
+        try:
+            automaton = FSA.compileAutomaton(gram, roots, separateRoots=True)
+            unionAutomata[key] = (automaton, names)
+        except ValueError:
+            unionAutomata[key] = None
+    return unionAutomata[key]
+
 # Characters
 GREEK_LOWER = "αβγδεζηθικλμνξοπρσςτυχφψω"
 GREEK_VOWELS = "αεηιουω"
@@ -163,8 +228,13 @@ def skipLine(line):
     else:
         return False
 
-# holds a greek unicode character
+# holds a greek unicode character. Chars of the Greek blocks are shared by
+# every occurrence of their character (see getChar), so they can't be
+# changed once built, and can't be given other attributes.
 class Char(object):
+    __slots__ = ["rawChar", "baseChar", "isSpace", "valid", "breathing", "accent",
+                 "hasIotaSubscript", "hasDiaeresis", "d", "built"]
+
     def __init__(self, inputChar):
         self.rawChar = inputChar
 
@@ -206,6 +276,12 @@ class Char(object):
                 self.hasDiaeresis = True
 
         self.d = decomp
+        self.built = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "built", False):
+            raise AttributeError("Chars can't be changed once built")
+        object.__setattr__(self, name, value)
 
     def __repr__(self):
         if not(self.valid):
@@ -234,6 +310,36 @@ class Char(object):
             # for c in self.d:
             #     utils.printUnicodeChar(c)
 
+# the code points of the Greek and Greek Extended blocks, as ranges
+GREEK_BLOCKS = [
+    (0x0370, 0x0400),
+    (0x1F00, 0x2000)
+]
+
+# maps characters to their shared Chars. Every character of the Greek blocks
+# is decomposed once, when this module is loaded, so looking up a character
+# in a line is a single dictionary access. Nothing else is added to it, so it
+# can't grow however many other characters the lines have.
+charTable = {}
+
+# fill charTable with the Chars of the Greek blocks and the space
+def buildCharTable():
+    for first, last in GREEK_BLOCKS:
+        for code in range(first, last):
+            c = chr(code)
+            charTable[c] = Char(c)
+    charTable[" "] = Char(" ")
+
+buildCharTable()
+
+# return the Char for a unicode character: the shared one for a character of
+# the Greek blocks or the space, or a new one for any other
+def getChar(c):
+    char = charTable.get(c)
+    if char == None:
+        return Char(c)
+    return char
+
 # holds a Greek phoneme
 class Phoneme(object):
     def __init__(self, inputChars):
@@ -367,9 +473,9 @@ def formDiphthong(c1, c2):
 def extractChars(line):
     chars = []
     for c in line:
-        char = Char(c)
-        chars.append(char)
-    chars = list(filter(lambda x: x.valid, chars))
+        char = getChar(c)
+        if char.valid:
+            chars.append(char)
     return chars
 
 # given a list of characters, combine diphthongs and remove spaces to get
@@ -472,9 +578,12 @@ def phonsToVowCons(phons):
     return vcSegs
 
 
-# given a line, segment it into constituent parts
-# also return a list of characters being examined
-def segmentLine(lineObj):
+# given a line, segment it into constituent parts, as a list of phonemes
+# grouped into vowels and the consonants after them (see phonsToVowCons)
+# also return a list of characters being examined. This is the readable
+# version of segmentLine; getLineSegments converts its segments to the form
+# getSpans takes.
+def segmentLinePhonemes(lineObj):
     line = lineObj["line_text"].lower()
     # print(line)
     chars = extractChars(line)
@@ -498,6 +607,216 @@ def segmentLine(lineObj):
 
     return vcSegments, outwardChars
 
+# Lines are usually segmented all at once rather than a character at a
+# time. The characters of the line are mapped to single letter classes with
+# str.translate, and diphthongs and vowels are found with a regex over the
+# class string. The result is a LineSegments, which holds the numbers of
+# characters and consonants around each vowel of the line (a single vowel or
+# a diphthong) and bitsets of SEG flags about it:
+SEG_LONG = 1            # the vowel is definitely long
+SEG_SHORT = 2           # the vowel is definitely short
+SEG_BEFORE_SPACE = 4    # the vowel ends a word
+SEG_EPSILON = 8         # the vowel is a plain epsilon
+SEG_COMBINES = 16       # the vowel can combine with an epsilon before it
+SEG_DOUBLE_NEXT = 32    # the first consonant after the vowel is double
+SEG_MUTE_LIQUID = 64    # the consonants after the vowel are a mute/liquid pair
+SEG_WORD_END = 128      # a word ends between the vowel and the next one
+
+# the segments of a line in the form getSpans takes. leading is the number
+# of consonants before the first vowel, and for each vowel in order, lengths
+# holds its number of characters, consonants the number of consonants after
+# it up to the next vowel, and flags its SEG flags.
+class LineSegments(object):
+    def __init__(self):
+        self.leading = 0
+        self.lengths = []
+        self.consonants = []
+        self.flags = []
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __eq__(self, other):
+        return (self.leading == other.leading and self.lengths == other.lengths
+                and self.consonants == other.consonants and self.flags == other.flags)
+
+    def __repr__(self):
+        return "LineSegments(%d, %s, %s, %s)" % (self.leading, str(self.lengths),
+                                                 str(self.consonants), str(self.flags))
+
+# convert a list of vowel-consonant segments from phonsToVowCons to a
+# LineSegments
+def getLineSegments(vcSegs):
+    segs = LineSegments()
+    if len(vcSegs) == 0:
+        return segs
+
+    segs.leading = len(vcSegs[0]["c"])
+    for seg in vcSegs[1:]:
+        vow = seg["v"]
+        cons = seg["c"]
+        flags = 0
+        if vow.isLongVowel():
+            flags |= SEG_LONG
+        if vow.isShortVowel():
+            flags |= SEG_SHORT
+        if vow.beforeSpace:
+            flags |= SEG_BEFORE_SPACE
+        if vow.baseChar == "ε":
+            flags |= SEG_EPSILON
+        if (vow.baseChar in "αοω") or vow.baseChar == "οι" or vow.baseChar == "ου":
+            flags |= SEG_COMBINES
+        if len(cons) > 0 and cons[0].baseChar in GREEK_DOUBLECONS:
+            flags |= SEG_DOUBLE_NEXT
+        if isMuteLiquid(cons):
+            flags |= SEG_MUTE_LIQUID
+        if vow.beforeSpace or any([con.beforeSpace for con in cons]):
+            flags |= SEG_WORD_END
+        segs.lengths.append(len(vow.baseChar))
+        segs.consonants.append(len(cons))
+        segs.flags.append(flags)
+    return segs
+
+# Character classes:
+# A: α, ε or ο with no accent or breathing, which can start a diphthong
+# H: η or ω with no accent or breathing, which can start a diphthong with υ
+# I, U: ι or υ with no diaeresis, which can end a diphthong
+# v: any other vowel
+# m, l, d, c: mutes, liquids, double consonants and other consonants
+# Spaces stay spaces and everything else is dropped, as extractChars does.
+# Splitting a line's classes on vowels gives the consonants and spaces
+# before the first vowel, then each vowel and the gap after it in turn.
+VOWEL_SPLIT_RE = re.compile(r"(A[IU]|HU|[AHIUv])")
+
+# a dict that works out the value for a key with a function the first time
+# the key is looked up. Used as a table for str.translate, and for things
+# there are only a few hundred of, like the vowels of the lines. Once it
+# holds maxSize keys, values for new keys are worked out every time they
+# are looked up instead of being kept, so unusual input can't make it grow
+# without bound.
+LAZY_TABLE_SIZE = 4096
+class LazyTable(dict):
+    def __init__(self, getValue, maxSize=LAZY_TABLE_SIZE):
+        dict.__init__(self)
+        self.getValue = getValue
+        self.maxSize = maxSize
+
+    def __missing__(self, key):
+        value = self.getValue(key)
+        if len(self) < self.maxSize:
+            self[key] = value
+        return value
+
+# return the class of the character with a code point, or None if it is
+# dropped
+def getCharClass(code):
+    char = getChar(chr(code))
+    if not(char.valid):
+        return None
+    if char.isSpace:
+        return " "
+    base = char.baseChar
+    if base in GREEK_VOWELS:
+        if base in "αεοηω" and char.accent == None and char.breathing == None:
+            return "A" if base in "αεο" else "H"
+        if base == "ι" and not(char.hasDiaeresis):
+            return "I"
+        if base == "υ" and not(char.hasDiaeresis):
+            return "U"
+        return "v"
+    if base in GREEK_MUTES:
+        return "m"
+    if base in GREEK_LIQUIDS:
+        return "l"
+    if base in GREEK_DOUBLECONS:
+        return "d"
+    return "c"
+
+# return the character with a code point if it is kept in the line, or None
+# if it is dropped
+def getKeptChar(code):
+    char = getChar(chr(code))
+    if char.valid:
+        return char.rawChar
+    return None
+
+# return the SEG flags a vowel gets from its own characters, and whether it
+# has an acute accent, given its text
+def getVowelInfo(text):
+    if len(text) == 2:
+        first = getChar(text[0])
+        second = getChar(text[1])
+        base = first.baseChar + second.baseChar
+        flags = SEG_LONG
+        if base == "οι" or base == "ου":
+            flags |= SEG_COMBINES
+        return flags, second.accent == ACCENT.ACUTE
+
+    char = getChar(text)
+    base = char.baseChar
+    flags = 0
+    if base in "ηω" or char.accent == ACCENT.CIRCUM or char.hasIotaSubscript:
+        flags |= SEG_LONG
+    if base in "εο":
+        flags |= SEG_SHORT
+    if base == "ε":
+        flags |= SEG_EPSILON
+    if base in "αοω":
+        flags |= SEG_COMBINES
+    return flags, char.accent == ACCENT.ACUTE
+
+# return the number of consonants in the classes of the gap after a vowel,
+# and the SEG flags the gap gives the vowel
+def getGapInfo(gap):
+    cons = gap.replace(" ", "")
+    flags = 0
+    if gap[:1] == " ":
+        flags |= SEG_BEFORE_SPACE
+    if " " in gap:
+        flags |= SEG_WORD_END
+    if cons[:1] == "d":
+        flags |= SEG_DOUBLE_NEXT
+    if cons == "ml":
+        flags |= SEG_MUTE_LIQUID
+    return len(cons), flags
+
+charClassTable = LazyTable(getCharClass)
+keptCharTable = LazyTable(getKeptChar)
+vowelTable = LazyTable(getVowelInfo)
+gapTable = LazyTable(getGapInfo)
+
+# given a line, segment it into a LineSegments, all at once. Also return a
+# list of the characters being examined. Gives the same segments as
+# segmentLinePhonemes.
+def segmentLine(lineObj):
+    line = lineObj["line_text"].lower()
+    kept = line.translate(keptCharTable)
+    classes = kept.translate(charClassTable)
+    outwardChars = list(kept.replace(" ", ""))
+
+    parts = VOWEL_SPLIT_RE.split(classes)
+    ends = list(itertools.accumulate(map(len, parts)))
+    vowels = [kept[ends[k-1]:ends[k]] for k in range(1, len(parts), 2)]
+    vowelInfo = list(map(vowelTable.__getitem__, vowels))
+    gapInfo = list(map(gapTable.__getitem__, parts[2::2]))
+
+    segs = LineSegments()
+    segs.leading = gapTable[parts[0]][0]
+    segs.lengths = list(map(len, parts[1::2]))
+    segs.consonants = [info[0] for info in gapInfo]
+    segs.flags = [v[0] | g[1] for v, g in zip(vowelInfo, gapInfo)]
+
+    # a vowel with an acute accent is also short if the next vowel is the
+    # last of the word and may be short (see Phoneme.isShortVowel)
+    flags = segs.flags
+    last = len(flags) - 1
+    for k in [k for k in range(last) if vowelInfo[k][1]]:
+        if (not(flags[k] & SEG_BEFORE_SPACE) and not(flags[k+1] & SEG_LONG)
+            and (k + 1 == last or (flags[k+1] & SEG_BEFORE_SPACE))):
+            flags[k] |= SEG_SHORT
+
+    return segs, outwardChars
+
 # ===========================================================================
 # ============================ Span Calculation =============================
 # ===========================================================================
@@ -519,60 +838,60 @@ def isMuteLiquid(cons):
     return False
 
 
-# potentially combine the current vowel with a previous epsilon
-def epsilonCombo(prev, vow, lastSCI, end):
+# potentially combine vowel i of the segments with a previous epsilon
+def epsilonCombo(segs, i, lastSCI, end):
     sylSpans = []
-    if (not(prev == None) and len(prev["c"]) == 0 and prev["v"].baseChar == "ε"
-        and not(prev["v"].beforeSpace) and ((vow.baseChar in "αοω") or vow.baseChar == "οι" or vow.baseChar == "ου")):
+    if (i > 0 and segs.consonants[i-1] == 0 and (segs.flags[i-1] & SEG_EPSILON)
+        and not(segs.flags[i-1] & SEG_BEFORE_SPACE) and (segs.flags[i] & SEG_COMBINES)):
         for prev_start, _ in lastSCI:
             span = (SYM.LONG, prev_start, end, [[], False], getFeatureArr(epsilonCombo=True))
             sylSpans.append(span)
     return sylSpans
 
-# given information, return the spans for a closed syllable version
-def getClosedSylSpans(start, cont, seg, prev, lastSCI, isLast, muteLiquid=False):
+# given information, return the spans for a closed syllable version of
+# vowel i of the segments
+def getClosedSylSpans(start, cont, segs, i, lastSCI, isLast, muteLiquid=False):
     sylSpans = []
-    vow = seg["v"]
 
     # last span needs to include all final consonants
     if isLast:
-        end = cont + len(vow.baseChar) + len(seg["c"])
+        end = cont + segs.lengths[i] + segs.consonants[i]
         nextCont = end
     else:
-        end = cont + len(vow.baseChar) + 1
-        nextCont = end + len(seg["c"]) - 1
+        end = cont + segs.lengths[i] + 1
+        nextCont = end + segs.consonants[i] - 1
 
     span = (SYM.LONG, start, end, [[], False], getFeatureArr(muteLiquid=muteLiquid))
     sylSpans.append(span)
 
     # add the epsilon combo version
-    sylSpans.extend(epsilonCombo(prev, vow, lastSCI, end))
+    sylSpans.extend(epsilonCombo(segs, i, lastSCI, end))
 
     nextSC = [(end, nextCont)]
     return sylSpans, nextSC
 
-# given information, return spans for an open syllable version
-def getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast):
+# given information, return spans for an open syllable version of vowel i
+# of the segments
+def getOpenSylSpans(start, cont, segs, i, lastSCI, isLast):
     sylSpans = []
-    vow = seg["v"]
-    cons = seg["c"]
-    numCons = len(seg["c"])
+    flags = segs.flags[i]
+    numCons = segs.consonants[i]
 
     # last span needs to include all final consonants
     if isLast:
-        end = cont + len(vow.baseChar) + numCons
+        end = cont + segs.lengths[i] + numCons
         nextCont = end
     else:
-        end = cont + len(vow.baseChar)
+        end = cont + segs.lengths[i]
         nextCont = end + numCons
 
     # if this is followed by a double consonant, it is long
-    if (numCons > 0 and cons[0].baseChar in GREEK_DOUBLECONS):
+    if (flags & SEG_DOUBLE_NEXT):
         span = (SYM.LONG, start, end, [[], False], getFeatureArr())
         sylSpans.append(span)
     else: # else
-        definitelyLong = vow.isLongVowel()
-        definitelyShort = vow.isShortVowel()
+        definitelyLong = flags & SEG_LONG
+        definitelyShort = flags & SEG_SHORT
         # if this vowel is a diphthong or definitely long
         if (definitelyLong):
             # this syllable is long
@@ -580,7 +899,7 @@ def getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast):
             sylSpans.append(span)
 
             # it could be short if there is epic correption
-            if (numCons == 0 and vow.beforeSpace):
+            if (numCons == 0 and (flags & SEG_BEFORE_SPACE)):
                 span = (SYM.SHORT, start, end, [[], False], getFeatureArr(epicCorreption=True))
                 sylSpans.append(span)
             elif (numCons == 0 and not(isLast)): # or internal correption
@@ -596,98 +915,143 @@ def getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast):
             sylSpans.append(span)
 
     # add the epsilon combo version
-    sylSpans.extend(epsilonCombo(prev, vow, lastSCI, end))
+    sylSpans.extend(epsilonCombo(segs, i, lastSCI, end))
 
     nextSC = [(end, nextCont)]
     return sylSpans, nextSC
 
-# given two spans, are they functionally equivalent?
-def spansEqual(sp, sp2):
-    l1, s1, e1, mem1, vec1 = sp
-    l2, s2, e2, mem2, vec2 = sp2
-
-    lEq = l1 == l2
-    sEq = s1 == s2
-    eEq = e1 == e2
-    # TODO: could check memory
-
-    vecEq = np.all(vec1 == vec2)
-
-    return (lEq and sEq and eEq and vecEq)
-
-# given a list of vowel-consonant segments, return a list of spans
+# return a hashable key for a span, the same for spans that are
+# functionally equivalent: the same symbol, start, end and weight vector,
+# with the vector packed into bytes (memory isn't compared)
+def getSpanKey(span):
+    sym, start, end, _, vec = span
+    return (sym, start, end, vec.tobytes())
+
+# return the spans of newSpans that aren't functionally equivalent to any
+# of spans, in order
+def getUniqueSpans(spans, newSpans):
+    seen = set([getSpanKey(sp) for sp in spans])
+    return [sp for sp in newSpans if not(getSpanKey(sp) in seen)]
+
+# given the segments of a line (see LineSegments), return the spans for
+# vowel i and the next start/continue pairs, given the start/continue pairs
+# for it and those for the vowel before it
+def getVowelSpans(segs, i, startContinueIndices, lastSCI, isLast):
+    spans = []
+    nextSCI = []
+    numCons = segs.consonants[i]
+
+    for sc in startContinueIndices:
+        start, cont = sc
+        if (segs.flags[i] & SEG_MUTE_LIQUID):
+            # this is followed by a mute/liquid pair, so
+            # run both setups
+            sylSpans, nextSCI = getOpenSylSpans(start, cont, segs, i, lastSCI, isLast)
+            spans.extend(sylSpans)
+
+            sylSpans2, nextSCI2 = getClosedSylSpans(start, cont, segs, i, lastSCI, isLast, muteLiquid=True)
+
+            # avoid double counting
+            spans.extend(getUniqueSpans(sylSpans, sylSpans2))
+
+            nextSCI.extend(nextSCI2)
+        elif (isLast and numCons > 0):
+            # special handling for the final syllable
+            sylSpans, nextSCI = getOpenSylSpans(start, cont, segs, i, lastSCI, isLast)
+            spans.extend(sylSpans)
+            sylSpans2, nextSCI = getClosedSylSpans(start, cont, segs, i, lastSCI, isLast)
+
+            # avoid double counting
+            spans.extend(getUniqueSpans(sylSpans, sylSpans2))
+        elif numCons > 1:
+            # if the this is followed by multiple consonants,
+            # we steal the next consonant
+            sylSpans, nextSCI = getClosedSylSpans(start, cont, segs, i, lastSCI, isLast)
+            spans.extend(sylSpans)
+        else:
+            # followed by a single cononsonant, so this is an open syllable,
+            # no consonant stealing
+            sylSpans, nextSCI = getOpenSylSpans(start, cont, segs, i, lastSCI, isLast)
+            spans.extend(sylSpans)
+    return spans, nextSCI
+
+# return the spans for the vowels first to last of the segments and the
+# start/continue pairs after them, given the start/continue pairs for the
+# first. isLastWord is true if the last vowel is the last of the line.
+def getWordSpans(segs, first, last, startContinueIndices, isLastWord):
+    spans = []
+    lastSCI = None
+    for i in range(first, last + 1):
+        isLast = isLastWord and i == last
+        sylSpans, nextSCI = getVowelSpans(segs, i, startContinueIndices, lastSCI, isLast)
+        spans.extend(sylSpans)
+        lastSCI = startContinueIndices
+        startContinueIndices = nextSCI
+    return spans, startContinueIndices
+
+# The spans of a word only depend on its vowels, the consonants between
+# them and the ones after its last vowel, which include the onset of the
+# next word, and on where its first syllable can start. So they are cached
+# as templates, keyed on those and on whether the word ends the line, with
+# positions relative to the word's first vowel; a template is shifted to the
+# word's place in the line when it is used. Templates are tuples of
+# (spans, start/continue pairs after the word)
+# with the spans as (symbol, start, end, weight vector). A template's weight
+# vectors are never handed out: every span placed from it gets its own empty
+# memory and a copy of its weight vector, since parses are built around the
+# arrays of the spans and changing a parse mustn't change the cache.
+WORD_SPAN_CACHE_SIZE = 50000
+wordSpanCache = utils.LRUCache(WORD_SPAN_CACHE_SIZE)
+
+# return the hits, misses and evictions of the word span cache, along with
+# its size and hit rate, as a dict
+def getSpanCacheStats():
+    return wordSpanCache.getStats()
+
+# drop every word span template and reset the counters
+def clearSpanCache():
+    wordSpanCache.clear()
+
+# given the segments of a line (see LineSegments), return a list of spans
 # for the chart
 def getSpans(segs):
     spans = []
 
-    if len(segs) == 0:
-        return spans
-
     # store a set pairs where the pair represents the start of the next
     # span to create and the character that one is continuing from
-    startContinueIndices = [(0, 0)]
-
-    startSeg = 0
-    if segs[0]["v"] == None:
-        startContinueIndices = [(0, len(segs[0]["c"]))]
-        startSeg = 1
+    startContinueIndices = [(0, segs.leading)]
 
     # example span ("AB", 0, 2, [[], False], np.array([0, 0]))
-    lastSCI = None
-    for i, seg in enumerate(segs[startSeg:]):
-        isLast = i == len(segs)-1-startSeg
-        nextSCI = []
-        if i > 0 and not(segs[i-1+startSeg]["v"] == None):
-            prev = segs[i-1+startSeg]
-        else:
-            prev = None
-
-        for sc in startContinueIndices:
-            start, cont = sc
-            if (isMuteLiquid(seg["c"])):
-                # this is followed by a mute/liquid pair, so
-                # run both setups
-                sylSpans, nextSCI = getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast)
-                spans.extend(sylSpans)
-
-                sylSpans2, nextSCI2 = getClosedSylSpans(start, cont, seg, prev, lastSCI, isLast, muteLiquid=True)
-
-                # avoid double counting
-                for sp2 in sylSpans2:
-                    uniq = True
-                    for sp in sylSpans:
-                        if spansEqual(sp, sp2):
-                            uniq = False
-                    if uniq:
-                        spans.append(sp2)
-
-                nextSCI.extend(nextSCI2)
-            elif (isLast and len(seg["c"]) > 0):
-                # special handling for the final syllable
-                sylSpans, nextSCI = getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast)
-                spans.extend(sylSpans)
-                sylSpans2, nextSCI = getClosedSylSpans(start, cont, seg, prev, lastSCI, isLast)
-
-                # avoid double counting
-                for sp2 in sylSpans2:
-                    uniq = True
-                    for sp in sylSpans:
-                        if spansEqual(sp, sp2):
-                            uniq = False
-                    if uniq:
-                        spans.append(sp2)
-            elif len(seg["c"]) > 1:
-                # if the this is followed by multiple consonants,
-                # we steal the next consonant
-                sylSpans, nextSCI = getClosedSylSpans(start, cont, seg, prev, lastSCI, isLast)
-                spans.extend(sylSpans)
-            else:
-                # followed by a single cononsonant, so this is an open syllable,
-                # no consonant stealing
-                sylSpans, nextSCI = getOpenSylSpans(start, cont, seg, prev, lastSCI, isLast)
-                spans.extend(sylSpans)
-        lastSCI = startContinueIndices
-        startContinueIndices = nextSCI
+    numVowels = len(segs)
+    if numVowels == 0:
+        return spans
+
+    # each vowel's length, consonants and flags packed into one number, and
+    # the last vowel of each word
+    flags = segs.flags
+    codes = [f | (c << 8) | (l << 16) for l, c, f in zip(segs.lengths, segs.consonants, flags)]
+    wordEnds = [i for i in range(numVowels - 1) if flags[i] & SEG_WORD_END]
+    wordEnds.append(numVowels - 1)
+
+    first = 0
+    for last in wordEnds:
+        isLastWord = last == numVowels - 1
+
+        # every start/continue pair continues from the word's first vowel
+        base = startContinueIndices[0][1]
+        key = (tuple(codes[first:last+1]),
+               tuple([start - base for start, _ in startContinueIndices]), isLastWord)
+        template = wordSpanCache.get(key)
+        if template == None:
+            wordSpans, nextSCI = getWordSpans(segs, first, last, startContinueIndices, isLastWord)
+            template = ([(sym, start - base, end - base, vec) for sym, start, end, _, vec in wordSpans],
+                        [(start - base, cont - base) for start, cont in nextSCI])
+            wordSpanCache.put(key, template)
+
+        wordSpans, nextSCI = template
+        spans.extend([(sym, start + base, end + base, [[], False], vec.copy()) for sym, start, end, vec in wordSpans])
+        startContinueIndices = [(start + base, cont + base) for start, cont in nextSCI]
+        first = last + 1
 
     # print("Spans:")
     # for span in spans:
@@ -697,8 +1061,9 @@ def getSpans(segs):
 
     return spans
 
-# given tokens,  input spans and meter, get the parses for the line
-def getParses(tokens, spans, meter):
+# split spans into those on the diagonal of the chart and those in its
+# interior
+def getInit(spans):
     lexInit = []
     interiorInit = []
     for span in spans:
@@ -708,11 +1073,22 @@ def getParses(tokens, spans, meter):
         else:
             interiorInit.append(span)
 
-    init = [lexInit, interiorInit]
+    return [lexInit, interiorInit]
+
+# given tokens,  input spans and meter, get the parses for the line. Unless
+# pareto is False, parses through chart entries whose features are beaten
+# by another entry are left out; pickBestParse picks the same parse either
+# way (see CKY.Chart). stats optionally collects counts and timings (see
+# CKY.ParseStats), and budget optionally limits the work done (see
+# CKY.ParseBudget).
+def getParses(tokens, spans, meter, pareto=True, stats=None, budget=None):
+    init = getInit(spans)
     root = [SYM.LINE]
 
     gram = meterGrammars[meter]
-    parses = CKY.runFullCustomInit(tokens, init, gram, root, printPrs=False)
+    parses = CKY.runFullCustomInit(tokens, init, gram, root, printPrs=False,
+                                   pareto=pareto, flagIndex=BEST_PARSE_FLAG,
+                                   stats=stats, budget=budget)
 
     # print("." + ".".join(tokens) + ".")
     # print(" ".join(list(map(lambda x: str(x)[-1], range(len(tokens)+1)))))
@@ -722,6 +1098,51 @@ def getParses(tokens, spans, meter):
 
     return parses
 
+# given tokens, input spans and meter, return true if the line scans in that
+# meter, without working out any of its parses
+def canParse(tokens, spans, meter):
+    init = getInit(spans)
+    root = [SYM.LINE]
+
+    gram = meterGrammars[meter]
+    return CKY.recognizeCustomInit(tokens, init, gram, root)
+
+# Costs for the best parse search. Whatever parse pickBestParse would choose
+# from the full list of parses is the best one under one of these costs:
+# fewest features, fewest features other than resolution, or simply the
+# first parse; each kept separately for parses with and without proper
+# name resolution.
+BEST_PARSE_COSTS = [
+    np.ones((6)),
+    np.array([0, 1, 1, 1, 1, 1]),
+    np.zeros((6))
+]
+BEST_PARSE_FLAG = 5
+
+# given tokens, input spans and meter, get a short list of candidate parses
+# for the line without enumerating every parse. pickBestParse picks the
+# same parse from this list as it would from the list getParses returns.
+# stats and budget are as for getParses.
+def getBestParses(tokens, spans, meter, stats=None, budget=None):
+    init = getInit(spans)
+    root = [SYM.LINE]
+
+    gram = meterGrammars[meter]
+    parses = CKY.runBestCustomInit(tokens, init, gram, root, BEST_PARSE_COSTS,
+                                   BEST_PARSE_FLAG, stats=stats, budget=budget)
+
+    return parses
+
+# given tokens, input spans and a meter with an automaton, get the same
+# candidate parses as getBestParses by finding the best paths through the
+# lattice of spans. Returns an empty list if the line doesn't scan. stats
+# optionally collects timings, and budget is as for getParses.
+def getAutomatonParses(tokens, spans, meter, stats=None, budget=None):
+    init = getInit(spans)
+    automaton = getMeterAutomaton(meter)
+    return FSA.runBestCustomInit(tokens, init, automaton, BEST_PARSE_COSTS,
+                                 BEST_PARSE_FLAG, stats=stats, budget=budget)
+
 
 # given a list of possible parses, return the index of the best one
 # 0: resolution
@@ -788,6 +1209,59 @@ def pickBestParse(parses):
 #     print(pickBestParse(parsesT))
 # print("---")
 
+# given the feature vectors of every parse of a line, return a function
+# giving the rank of a feature vector in the order pickBestParse prefers
+# parses. Parses with equal ranks are preferred in the order getParses
+# returns them, so taking the lowest ranked parse again and again gives the
+# same order as calling pickBestParse on the parses that are left.
+def getParseRankKey(vecs):
+    # whether there are parses with neither of the first two preferences
+    # nor proper name resolution
+    hasPlain = False
+    for vec in vecs:
+        vecSum = np.sum(vec)
+        if (not(vecSum == 0) and not(vecSum - (vec[0]-vec[5]) + vec[4] == 0)
+            and not(vec[5])):
+            hasPlain = True
+
+    def rankKey(vec):
+        vecSum = float(np.sum(vec))
+        if (vecSum == 0):
+            return (0, 0)
+        if (vecSum - (vec[0]-vec[5]) + vec[4] == 0):
+            return (1, 0)
+        # parses with proper name resolution come first in order if there
+        # are other parses, otherwise by their number of features
+        if (vec[5]):
+            if hasPlain:
+                return (2, 0)
+            return (2, vecSum)
+        return (3, vecSum)
+
+    return rankKey
+
+# given tokens, input spans and meter, get the parse forest for the line
+def getForest(tokens, spans, meter):
+    init = getInit(spans)
+    root = [SYM.LINE]
+
+    gram = meterGrammars[meter]
+    return CKY.runForestCustomInit(tokens, init, gram, root)
+
+# given a line and a meter, lazily yield its scansions best first. The first
+# is the one scanLine returns.
+def iterScansions(line, meter):
+    segmented, keyChars = segmentLine(line)
+    spans = getSpans(segmented)
+    forest = getForest(keyChars, spans, meter)
+
+    rankKey = getParseRankKey([node.vec for node in forest.roots])
+    return CKY.iterForestParses(forest, rankKey)
+
+# given a line and a meter, return up to k of its best scansions, best first
+def scanLineKBest(line, meter, k):
+    return list(itertools.islice(iterScansions(line, meter), k))
+
 # get the string for a single foot
 def printFoot(sp):
     s = []
@@ -810,13 +1284,187 @@ def getScanString(parse):
     return "|".join(s)
 
 
-# given a line and a meter, attempt to scan that line
-def scanLine(line, meter, printSpans=False):
+# return a label for a line, for reporting it
+def getLineLabel(line):
+    return "%s: %s" % (str(line.get("line_number", "?")), line["line_text"])
+
+# the result of scanning a line that ran out of its budget before its
+# parses were found, returned in place of a parse. reason is "entries" or
+# "time" and amount is how far the parser got (see CKY.BudgetExceededError),
+# and stats holds the counts and timings for the line up to that point, with
+# the time of the phase that ran out under "overBudget".
+class BudgetExceeded(object):
+    def __init__(self, line, error, stats):
+        self.line = line
+        self.reason = error.reason
+        self.amount = error.amount
+        self.stats = stats
+
+    def __repr__(self):
+        return "BudgetExceeded(%s, %s, %s)" % (getLineLabel(self.line), self.reason, str(self.amount))
+
+# return true if a scan result is a BudgetExceeded rather than a parse or None
+def isBudgetExceeded(result):
+    return isinstance(result, BudgetExceeded)
+
+# count a scanned line and its time in its statistics, adding them to stats
+# if it is given
+def finishLineStats(line, lineStats, lineStart, stats):
+    lineStats.lines += 1
+    lineStats.addLineTime(time.time() - lineStart, getLineLabel(line))
+    if not(stats == None):
+        stats.merge(lineStats)
+
+# finish the statistics of a line that ran out of its budget, adding them to
+# stats if it is given, and return its BudgetExceeded result
+def getBudgetExceeded(line, error, lineStats, lineStart, stats):
+    lineStats.endPhase("overBudget")
+    lineStats.linesOverBudget += 1
+    finishLineStats(line, lineStats, lineStart, stats)
+    return BudgetExceeded(line, error, lineStats)
+
+# The parses of a line only depend on its lattice of spans: which symbols
+# and weight vectors span which positions, in order, and its length. Lines
+# whose lattices are the same once their positions are renumbered in order
+# have the same best parses, with the positions renumbered the same way. So
+# the best parse of each lattice is cached for each meter, as a skeleton of
+# nested tuples of
+# (symbol, weight vector, start, end, children)
+# with renumbered positions and the weight vector as a tuple, and placed at a
+# line's own positions when used, with new arrays for its weight vectors, so
+# changing a parse can't change the cache.
+# The cache is keyed on the meters scanned together and the lattice's
+# signature, and holds a map from each meter to its skeleton, or None where
+# the lattice doesn't scan.
+LATTICE_CACHE_SIZE = 50000
+latticeCache = utils.LRUCache(LATTICE_CACHE_SIZE)
+
+# return the hits, misses and evictions of the lattice cache, along with its
+# size and hit rate, as a dict
+def getLatticeCacheStats():
+    return latticeCache.getStats()
+
+# drop every cached parse and reset the counters
+def clearLatticeCache():
+    latticeCache.clear()
+
+# given the spans of a line, its number of tokens and the meters to scan it
+# in, return its key in the lattice cache, the line's positions in order and
+# a map from each position to its number
+def getLattice(spans, numTokens, meters):
+    positions = set([0, numTokens])
+    for _, start, end, _, _ in spans:
+        positions.add(start)
+        positions.add(end)
+    positions = sorted(positions)
+    index = dict([(pos, i) for i, pos in enumerate(positions)])
+
+    signature = tuple([(sym, index[start], index[end], vec.tobytes()) for sym, start, end, _, vec in spans])
+    return ((tuple(meters), len(positions), signature), positions, index)
+
+# return the skeleton of a parse, with its positions renumbered by index
+def getParseSkeleton(parse, index):
+    start, end = parse["span"]
+    children = tuple([getParseSkeleton(child, index) for child in parse["children"]])
+    return (parse["sym"], tuple(parse["vec"].tolist()), index[start], index[end], children)
+
+# build a parse from a skeleton, placing it at the given positions
+def placeParseSkeleton(skeleton, positions):
+    sym, vec, start, end, children = skeleton
+    return {
+        "sym": sym,
+        "vec": np.array(vec),
+        "span": [positions[start], positions[end]],
+        "children": [placeParseSkeleton(child, positions) for child in children]
+    }
+
+# given a lattice from getLattice, return a map from each of its meters to
+# the cached best parse placed at the line's positions (None where it doesn't
+# scan), or None if the lattice hasn't been cached. Adds the hit or miss to
+# stats.
+def getCachedParses(lattice, stats):
+    key, positions, _ = lattice
+    skeletons = latticeCache.get(key)
+    if skeletons == None:
+        stats.latticeMisses += 1
+        return None
+
+    stats.latticeHits += 1
+    results = {}
+    for meter in skeletons:
+        results[meter] = None
+        if not(skeletons[meter] == None):
+            results[meter] = placeParseSkeleton(skeletons[meter], positions)
+    return results
+
+# check a line whose parses came from the lattice cache against its budget
+# (see CKY.ParseBudget), if it has one. Nothing is parsed for such a line,
+# so it builds no entries and only the time limit can apply to it, counting
+# from when the budget was started for the line. So a line that would run
+# out of entries when parsed gets its parse if its lattice is already
+# cached; lines that run out of their budget are never cached themselves.
+def checkCachedBudget(budget):
+    if not(budget == None):
+        budget.check(0)
+
+# cache the best parses for a lattice from getLattice, given as a map from
+# each of its meters to a parse or None
+def putCachedParses(lattice, results):
+    key, _, index = lattice
+    skeletons = {}
+    for meter in results:
+        skeletons[meter] = None
+        if not(results[meter] == None):
+            skeletons[meter] = getParseSkeleton(results[meter], index)
+    latticeCache.put(key, skeletons)
+
+# given a line and a meter, attempt to scan that line. If stats is given,
+# counts and timings for the line are added to it (see CKY.ParseStats). If
+# budget is given (see CKY.ParseBudget), it is started for the line, and a
+# BudgetExceeded is returned instead of a parse if the line runs out of it.
+# Unless printing, a line whose lattice of spans has been scanned before gets
+# its parse from the lattice cache without being parsed again, and only the
+# budget's time limit applies to it (see checkCachedBudget).
+def scanLine(line, meter, printSpans=False, stats=None, budget=None):
+    lineStats = CKY.ParseStats()
+    lineStart = time.time()
+    if not(budget == None):
+        budget.start()
+
     # line = {"line_text": "ετρε οι πης"}
     segmented, keyChars = segmentLine(line)
     spans = getSpans(segmented)
-
-    parses = getParses(keyChars, spans, meter)
+    lineStats.endPhase("segment")
+
+    if not(printSpans):
+        lattice = getLattice(spans, len(keyChars), [meter])
+        cached = getCachedParses(lattice, lineStats)
+        lineStats.endPhase("lattice")
+        if not(cached == None):
+            try:
+                checkCachedBudget(budget)
+            except CKY.BudgetExceededError as error:
+                return getBudgetExceeded(line, error, lineStats, lineStart, stats)
+            finishLineStats(line, lineStats, lineStart, stats)
+            return cached[meter]
+
+    # when printing, show every parse; otherwise only find the candidates
+    # for the best one, with the meter's automaton if it has one, or else
+    # with CKY if the line scans in this meter at all
+    try:
+        if printSpans:
+            parses = getParses(keyChars, spans, meter, pareto=False, stats=lineStats, budget=budget)
+        elif not(getMeterAutomaton(meter) == None):
+            parses = getAutomatonParses(keyChars, spans, meter, lineStats, budget)
+        else:
+            scans = canParse(keyChars, spans, meter)
+            lineStats.endPhase("recognize")
+            if scans:
+                parses = getBestParses(keyChars, spans, meter, stats=lineStats, budget=budget)
+            else:
+                parses = []
+    except CKY.BudgetExceededError as error:
+        return getBudgetExceeded(line, error, lineStats, lineStart, stats)
 
     if printSpans:
         print("." + ".".join(keyChars) + ".")
@@ -834,17 +1482,118 @@ def scanLine(line, meter, printSpans=False):
 
 
 
-    if (len(parses) == 0):
-        return None
-
-    bestParse = parses[pickBestParse(parses)]
+    lineStats.startPhase()
+    bestParse = None
+    if (len(parses) > 0):
+        bestParse = parses[pickBestParse(parses)]
+    if not(printSpans):
+        putCachedParses(lattice, {meter: bestParse})
+    lineStats.endPhase("pick")
 
+    finishLineStats(line, lineStats, lineStart, stats)
     return bestParse
 
-# return the best guess for a meter and a parse
+# rename the symbols of a parse from the union grammar back to their names
+# in the meter's own grammar
+def restoreParseSymbols(parse, names):
+    stack = [parse]
+    while len(stack) > 0:
+        node = stack.pop()
+        node["sym"] = names.get(node["sym"], node["sym"])
+        stack.extend(node["children"])
+
+# given a line and a list of meters (every meter in meterGrammars if not
+# given), scan the line in all of them with a single search of its lattice
+# of spans. Returns a map from each meter to its best parse, or None if the
+# line doesn't scan in it; the parses are the ones scanLine would return.
+# Falls back to scanning the meters one at a time if any of them has a
+# recursive grammar. stats and budget are as for scanLine; if the line runs
+# out of its budget, every meter maps to the same BudgetExceeded. Lines
+# whose lattice of spans has been scanned in the same meters before get their
+# parses from the lattice cache, as for scanLine.
+def scanLineMeters(line, meters=None, stats=None, budget=None):
+    if meters == None:
+        meters = list(meterGrammars.keys())
+    union = getUnionAutomaton(meters)
+    if union == None:
+        results = {}
+        for meter in meters:
+            results[meter] = scanLine(line, meter, stats=stats, budget=budget)
+        return results
+
+    lineStats = CKY.ParseStats()
+    lineStart = time.time()
+    if not(budget == None):
+        budget.start()
+
+    segmented, keyChars = segmentLine(line)
+    spans = getSpans(segmented)
+    lineStats.endPhase("segment")
+
+    lattice = getLattice(spans, len(keyChars), meters)
+    cached = getCachedParses(lattice, lineStats)
+    lineStats.endPhase("lattice")
+    if not(cached == None):
+        try:
+            checkCachedBudget(budget)
+        except CKY.BudgetExceededError as error:
+            result = getBudgetExceeded(line, error, lineStats, lineStart, stats)
+            return dict([(meter, result) for meter in meters])
+        finishLineStats(line, lineStats, lineStart, stats)
+        return cached
+
+    automaton, names = union
+    init = getInit(spans)
+    try:
+        rootParses = FSA.runBestPerRootCustomInit(keyChars, init, automaton, BEST_PARSE_COSTS,
+                                                  BEST_PARSE_FLAG, stats=lineStats, budget=budget)
+    except CKY.BudgetExceededError as error:
+        result = getBudgetExceeded(line, error, lineStats, lineStart, stats)
+        return dict([(meter, result) for meter in meters])
+
+    lineStats.startPhase()
+    results = {}
+    for meter in meters:
+        parses = rootParses[getUnionSymbol(meter, SYM.LINE)]
+        results[meter] = None
+        if (len(parses) > 0):
+            bestParse = parses[pickBestParse(parses)]
+            restoreParseSymbols(bestParse, names)
+            results[meter] = bestParse
+    putCachedParses(lattice, results)
+    lineStats.endPhase("pick")
+
+    finishLineStats(line, lineStats, lineStart, stats)
+    return results
+
+# given a line and a meter, return true if the line scans in that meter
+def lineScans(line, meter):
+    segmented, keyChars = segmentLine(line)
+    spans = getSpans(segmented)
+    return canParse(keyChars, spans, meter)
+
+# given a list of lines and a meter, attempt to scan every line, returning
+# the best parse for each (None for lines that do not scan), as scanLine
+# would. If stats is given, counts and timings across all the lines are
+# added to it. If budget is given, it applies to each line separately, and
+# lines that run out of it get a BudgetExceeded.
+def scanLines(lines, meter, stats=None, budget=None):
+    return [scanLine(line, meter, stats=stats, budget=budget) for line in lines]
+
+# given a list of lines, such as those of a book, and a meter, scan every
+# line and return the counts and timings across all of them (see
+# CKY.ParseStats)
+def getScanStats(lines, meter):
+    stats = CKY.ParseStats()
+    scanLines(lines, meter, stats=stats)
+    return stats
+
+# return the best guess for a meter and a parse. The line is scanned in
+# both meters in a single pass (see scanLineMeters).
 def guessMeterWithParse(line):
-    i = scanLine(line, "IAMBS")
-    a = scanLine(line, "ANAPESTS")
+    scans = scanLineMeters(line, ["IAMBS", "ANAPESTS"])
+    i = scans["IAMBS"]
+    a = scans["ANAPESTS"]
 
     if i == None and a == None:
         return "OTHER", None
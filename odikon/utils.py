@@ -10,6 +10,7 @@ import sys
 import copy
 import errno
 import unicodedata
+from collections import OrderedDict
 
 
 class Constant:
@@ -264,6 +265,57 @@ def getContent(inFileName, parseJSON):
     else:
         return inContents
 
+# a cache holding at most maxSize items, dropping the least recently used
+# item to make room for a new one. Counts its hits, misses and evictions.
+class LRUCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    # return the item for a key, or None if it is not cached
+    def get(self, key):
+        item = self.items.get(key)
+        if item == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item
+
+    # cache an item for a key, evicting the least recently used item if the
+    # cache is full
+    def put(self, key, item):
+        self.items[key] = item
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxSize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    # drop every item and reset the counters
+    def clear(self):
+        self.items.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # return the counters, the number of items and the hit rate as a dict
+    def getStats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.items),
+            "maxSize": self.maxSize,
+            "hitRate": self.hits / lookups if lookups > 0 else 0.0
+        }
+
 
 # ==============================================================================
 # ======================== Text Preprocessing Functions ========================
@@ -0,0 +1,357 @@
+# Measures how the phases of CKY scale with the length of the input, the
+# size of the grammar, the depth of unit chains and the amount of ambiguity,
+# on generated grammars and inputs along with a few of the small cases from
+# CKY.py. The time and peak memory of each phase are written to
+# output/scalingBenchmark.json, along with the exponent of a power law
+# fitted to each sweep and the memory held by each filled chart. The memory
+# of the charts for the first lines of Medea, parsed with CKY in iambs, is
+# measured too. Run with the path of an earlier results file to compare
+# against it:
+#   python scalingBenchmark.py [baseline.json]
+
+import sys
+import time
+import tracemalloc
+
+import odikon.utils as utils
+import odikon.CKY as CKY
+import odikon.scan as scan
+
+import numpy as np
+
+# number of times to run every case; the fastest time of each phase is kept
+NUM_REPEATS = 3
+
+OUTPUT_FILE = "output/scalingBenchmark.json"
+
+PHASES = ["compile", "init", "upward", "filter", "extract"]
+
+# the text and number of lines whose charts are measured, and their meter
+LINES_TEXT = "data/texts/Euripides-Medea.json"
+NUM_LINES = 300
+LINES_METER = "IAMBS"
+
+# ==== generated grammars and inputs
+
+# return a lexicon and grammar for lines of "a"s grouped into feet of two
+# tokens. ambiguity is the number of kinds of foot, each with its own
+# weight, so a line of n tokens has ambiguity^(n/2) parses. Tokens reach the
+# feet through a chain of unitDepth unit productions. numDecoys families of
+# rules are built on tokens that never appear in the input, so they make the
+# grammar bigger without adding any parses.
+def makeGrammar(ambiguity, unitDepth, numDecoys):
+    zero = np.array([0, 0])
+    lex = {"a": [("A", zero)]}
+    gram = [
+        ("S", ["F", "S"], zero),
+        ("S", ["F"], zero),
+    ]
+
+    for i in range(ambiguity):
+        foot = "F%d" % i
+        gram.append(("F", [foot], zero))
+        gram.append((foot, ["X", "X"], np.array([i, 0])))
+
+    chain = ["X"] + ["U%d" % k for k in range(1, unitDepth)] + ["A"]
+    for k in range(len(chain) - 1):
+        gram.append((chain[k], [chain[k + 1]], zero))
+
+    for j in range(numDecoys):
+        token = "b%d" % j
+        lex[token] = [("B%d" % j, zero)]
+        gram.append(("D%d" % j, ["B%d" % j, "B%d" % j, "B%d" % j], np.array([0, 1])))
+        gram.append(("S", ["D%d" % j, "S"], zero))
+        gram.append(("S", ["D%d" % j], zero))
+
+    return lex, gram
+
+# the parameters of the generated cases when they are not being varied
+DEFAULTS = {
+    "length": 16,
+    "ambiguity": 2,
+    "unitDepth": 2,
+    "numDecoys": 0
+}
+
+# each sweep varies one parameter, keeping the others at their defaults
+SWEEPS = [
+    ["length", [8, 16, 32, 48, 64, 96]],
+    ["numDecoys", [1, 4, 16, 64, 256]],
+    ["unitDepth", [1, 4, 16, 64, 256]],
+    ["ambiguity", [1, 2, 4, 8, 16]]
+]
+
+# ==== small cases from CKY.py
+
+TOY_CASES = [
+    ["ambiguity", list("abcd"), {
+        "a": [("A", np.array([0, 0]))],
+        "b": [("B", np.array([0, 0]))],
+        "c": [("C", np.array([0, 0]))],
+        "d": [("D", np.array([0, 0]))]
+    }, [
+        ("S", ["A", "B", "C", "D"], np.array([0, 0])),
+        ("S", ["AB", "CD"], np.array([0, 0])),
+        ("AB", ["A", "B"], np.array([1, 0])),
+        ("CD", ["C", "D"], np.array([0, 0])),
+        ("S", ["ABC", "D"], np.array([0, 1])),
+        ("ABC", ["A", "B", "C"], np.array([0, 0])),
+    ]],
+    ["deep ambiguity", list("abcdd"), {
+        "a": [("A", np.array([0, 0]))],
+        "b": [("B", np.array([0, 0]))],
+        "c": [("C", np.array([0, 0]))],
+        "d": [("D1", np.array([0, 0])), ("D2", np.array([0, 0]))]
+    }, [
+        ("S", ["A", "B", "C", "D"], np.array([0, 0])),
+        ("D", ["D1", "D1"], np.array([0, 0])),
+        ("D", ["D1", "D2"], np.array([0, 0])),
+    ]],
+    ["unit chains", list("abcd"), {
+        "a": [("A", np.array([0, 0]))],
+        "b": [("B", np.array([0, 0]))],
+        "c": [("C", np.array([0, 0]))],
+        "d": [("D", np.array([0, 0]))]
+    }, [
+        ("S", ["A", "B4", "C", "D"], np.array([0, 0])),
+        ("B4", ["B3"], np.array([0, 0])),
+        ("B3", ["B2"], np.array([0, 0])),
+        ("B2", ["B1"], np.array([0, 0])),
+        ("B1", ["B"], np.array([0, 0]))
+    ]]
+]
+
+# ==== running cases
+
+# return the number of parses in a marked chart, counting every way of
+# building each entry. Children are always earlier in the arena than the
+# entries built from them.
+def countParses(chart, rootIDs):
+    entries = chart.entries
+    counts = [0] * len(entries)
+    for index, entry in enumerate(entries):
+        for _, lid, did, _, _ in entry[CKY.ENTRY_BACKS]:
+            if lid < 0:
+                counts[index] += 1
+            else:
+                counts[index] += counts[lid] * counts[did]
+
+    N = len(chart)
+    if N == 0:
+        return 0
+    total = 0
+    for index in chart.getReachableCell(0, N-1):
+        total += counts[index]
+    return total
+
+# run every phase of CKY once on a case. Returns the time and the growth in
+# traced memory at its peak for each phase, and the chart's size, the traced
+# memory it holds once it is filled and marked, and its parse count (the
+# memory is only meaningful while tracemalloc is tracing). Only the first
+# parse is extracted, since there can be far too many to list.
+def runPhases(tokens, lex, gram, root):
+    times = {}
+    peaks = {}
+    tracing = tracemalloc.is_tracing()
+
+    def endPhase(phase, startTime, startMemory):
+        times[phase] = time.time() - startTime
+        if tracing:
+            peaks[phase] = tracemalloc.get_traced_memory()[1] - startMemory
+            tracemalloc.reset_peak()
+
+    def startPhase():
+        if tracing:
+            tracemalloc.reset_peak()
+            return time.time(), tracemalloc.get_traced_memory()[0]
+        return time.time(), 0
+
+    startTime, startMemory = startPhase()
+    grammar = CKY.CompiledGrammar(gram, lex).compile()
+    rootIDs = grammar.getSymbolIDs(root)
+    endPhase("compile", startTime, startMemory)
+
+    startTime, startMemory = startPhase()
+    N = len(tokens)
+    allowed = CKY.getYieldAllowed(N, CKY.getLexSpans(tokens, grammar), grammar, rootIDs)
+    chartStart = getTracedMemory()
+    chart = CKY.Chart(N)
+    chart = CKY.initFromLex(chart, tokens, grammar)
+    endPhase("init", startTime, startMemory)
+
+    startTime, startMemory = startPhase()
+    if not(allowed == None):
+        chart = CKY.runUpwards(chart, grammar, allowed)
+    endPhase("upward", startTime, startMemory)
+
+    startTime, startMemory = startPhase()
+    CKY.markReachable(chart, rootIDs)
+    endPhase("filter", startTime, startMemory)
+    chartMemory = getTracedMemory() - chartStart
+
+    startTime, startMemory = startPhase()
+    CKY.getParses(chart, grammar, firstOnly=True)
+    endPhase("extract", startTime, startMemory)
+
+    info = {
+        "entries": len(chart.entries),
+        "reachable": int(chart.reachable.sum()),
+        "chartMemory": chartMemory,
+        "parses": countParses(chart, rootIDs)
+    }
+    return times, peaks, info
+
+# return the memory tracemalloc is tracing right now, or 0 if it isn't
+def getTracedMemory():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+# return the traced memory held by the CKY chart of each of a list of lines
+# once it is filled and marked, parsing them in the given meter
+def measureLineCharts(lines, meter):
+    grammar = CKY.getCompiledGrammar(scan.meterGrammars[meter])
+    rootIDs = grammar.getSymbolIDs([scan.SYM.LINE])
+    sizes = []
+    tracemalloc.start()
+    for line in lines:
+        segmented, tokens = scan.segmentLine(line)
+        init = scan.getInit(scan.getSpans(segmented))
+        N = len(tokens)
+        allowed = CKY.getYieldAllowed(N, CKY.getInitSpans(init, grammar), grammar, rootIDs)
+        if allowed == None:
+            continue
+        chartStart = getTracedMemory()
+        chart = CKY.Chart(N, pareto=True, flagIndex=scan.BEST_PARSE_FLAG)
+        chart = CKY.initFromSpans(chart, init[0], init[1], grammar)
+        chart = CKY.runUpwards(chart, grammar, allowed)
+        CKY.markReachable(chart, rootIDs)
+        sizes.append(getTracedMemory() - chartStart)
+        del chart
+    tracemalloc.stop()
+    return sizes
+
+# run a case several times, returning a result record with the fastest time
+# and the peak memory of each phase
+def runCase(suite, name, params, tokens, lex, gram, root):
+    bestTimes = {}
+    for _ in range(NUM_REPEATS):
+        times, _, info = runPhases(tokens, lex, gram, root)
+        for phase in times:
+            bestTimes[phase] = min(bestTimes.get(phase, float("inf")), times[phase])
+
+    tracemalloc.start()
+    _, peaks, tracedInfo = runPhases(tokens, lex, gram, root)
+    tracemalloc.stop()
+
+    phases = {}
+    for phase in PHASES:
+        phases[phase] = {"time": bestTimes[phase], "peakMemory": peaks[phase]}
+
+    return {
+        "suite": suite,
+        "name": name,
+        "params": params,
+        "phases": phases,
+        "totalTime": sum(bestTimes.values()),
+        "entries": info["entries"],
+        "reachable": info["reachable"],
+        "chartMemory": tracedInfo["chartMemory"],
+        "parses": str(info["parses"])
+    }
+
+# return a key identifying a result, for matching it against a baseline
+def getResultKey(result):
+    params = ",".join(["%s=%s" % (key, result["params"][key]) for key in sorted(result["params"])])
+    return "%s/%s/%s" % (result["suite"], result["name"], params)
+
+# return the exponent of a power law fitted to how a phase's time grows
+# with a parameter, or None if there are too few points to fit
+def fitExponent(values, times):
+    points = [(v, t) for v, t in zip(values, times) if v > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    logValues = np.log([p[0] for p in points])
+    logTimes = np.log([p[1] for p in points])
+    return float(np.polyfit(logValues, logTimes, 1)[0])
+
+# ==== run the benchmark
+results = []
+report = []
+
+for name, tokens, lex, gram in TOY_CASES:
+    result = runCase("toy", name, {}, tokens, lex, gram, ["S"])
+    results.append(result)
+    report.append("toy %s: %.5fs, %d entries, %d bytes of chart, %s parses" %
+                  (name, result["totalTime"], result["entries"], result["chartMemory"], result["parses"]))
+
+fits = {}
+for param, values in SWEEPS:
+    sweepResults = []
+    for value in values:
+        params = dict(DEFAULTS)
+        params[param] = value
+        lex, gram = makeGrammar(params["ambiguity"], params["unitDepth"], params["numDecoys"])
+        tokens = ["a"] * params["length"]
+        result = runCase("sweep", param, params, tokens, lex, gram, ["S"])
+        results.append(result)
+        sweepResults.append(result)
+        report.append("%s=%d: %.5fs, %d entries, %d bytes of chart, %s parses" %
+                      (param, value, result["totalTime"], result["entries"], result["chartMemory"], result["parses"]))
+
+    fits[param] = {}
+    for phase in PHASES:
+        times = [r["phases"][phase]["time"] for r in sweepResults]
+        fits[param][phase] = fitExponent(values, times)
+    exponents = ", ".join(["%s %.2f" % (phase, fits[param][phase]) for phase in PHASES if not(fits[param][phase] == None)])
+    report.append("  time ~ %s^k with k: %s" % (param, exponents))
+
+text = utils.Text(LINES_TEXT)
+lines = []
+for book in text.books:
+    lines.extend(book.bookLines)
+sizes = measureLineCharts(lines[:NUM_LINES], LINES_METER)
+lineCharts = {
+    "text": text.textName,
+    "lines": NUM_LINES,
+    "meter": LINES_METER,
+    "charts": len(sizes),
+    "meanMemory": float(np.mean(sizes)) if len(sizes) > 0 else 0.0,
+    "maxMemory": max(sizes) if len(sizes) > 0 else 0
+}
+report.append("%s, first %d lines in %s: %d charts, %.0f bytes each on average, %d at most" %
+              (text.textName, NUM_LINES, LINES_METER, lineCharts["charts"],
+               lineCharts["meanMemory"], lineCharts["maxMemory"]))
+
+print("\n".join(report))
+utils.safeWrite(OUTPUT_FILE, {"results": results, "fits": fits, "lineCharts": lineCharts}, True)
+
+# compare against a baseline results file if one is given
+if len(sys.argv) > 1:
+    baseline = utils.getContent(sys.argv[1], True)
+    baseResults = {}
+    for result in baseline["results"]:
+        baseResults[getResultKey(result)] = result
+
+    comparison = []
+    for result in results:
+        key = getResultKey(result)
+        if not(key in baseResults):
+            comparison.append("%s: not in baseline" % key)
+            continue
+        base = baseResults[key]
+        ratios = []
+        for phase in PHASES:
+            baseTime = base["phases"][phase]["time"]
+            if baseTime > 0:
+                ratios.append("%s %.2fx" % (phase, result["phases"][phase]["time"] / baseTime))
+        if base.get("chartMemory", 0) > 0:
+            ratios.append("chart memory %.2fx" % (result["chartMemory"] / base["chartMemory"]))
+        comparison.append("%s: %s" % (key, ", ".join(ratios)))
+    if "lineCharts" in baseline and baseline["lineCharts"]["meanMemory"] > 0:
+        comparison.append("%s charts: memory %.2fx" % (text.textName,
+                          lineCharts["meanMemory"] / baseline["lineCharts"]["meanMemory"]))
+
+    print("----")
+    print("Time and memory compared to %s:" % sys.argv[1])
+    print("\n".join(comparison))
@@ -0,0 +1,68 @@
+# Tests for the scanner in odikon/scan.py, on lines of Medea. Run from the
+# top folder with:
+#   python -m pytest -q tests
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import odikon.utils as utils
+import odikon.scan as scan
+
+# return the first num lines of Medea, or all of them if num is None
+def getLines(num):
+    text = utils.Text(os.path.join(ROOT, "data/texts/Euripides-Medea.json"))
+    lines = []
+    for book in text.books:
+        lines.extend(book.bookLines)
+    return lines[:num]
+
+# return a parse as nested tuples, for comparing parses
+def getParseTree(parse):
+    if parse == None:
+        return None
+    children = tuple([getParseTree(child) for child in parse["children"]])
+    return (parse["sym"], tuple(parse["span"]), tuple(parse["vec"].tolist()), children)
+
+# change the weight vector of every node of a parse in place
+def changeParseVecs(parse):
+    stack = [parse]
+    while len(stack) > 0:
+        node = stack.pop()
+        node["vec"] += 7
+        stack.extend(node["children"])
+
+# the parses scanLine returns share nothing with the word span cache or the
+# lattice cache, so changing them doesn't change the scansions of later lines
+def test_changedParsesLeaveCachesIntact():
+    lines = getLines(100)
+    scan.clearSpanCache()
+    scan.clearLatticeCache()
+    expected = [getParseTree(scan.scanLine(line, "IAMBS")) for line in lines]
+    assert len([tree for tree in expected if not(tree == None)]) > 0
+
+    # parsed with spans from the word span cache, and changed
+    scan.clearLatticeCache()
+    for line in lines:
+        parse = scan.scanLine(line, "IAMBS")
+        assert getParseTree(parse) in expected
+        if not(parse == None):
+            changeParseVecs(parse)
+    assert scan.getSpanCacheStats()["hits"] > 0
+
+    # from the lattice cache
+    assert [getParseTree(scan.scanLine(line, "IAMBS")) for line in lines] == expected
+
+    # parsed again
+    scan.clearLatticeCache()
+    assert [getParseTree(scan.scanLine(line, "IAMBS")) for line in lines] == expected
+
+# segmentLine, which segments a line all at once, gives the same segments
+# and characters as the readable segmenter working on phonemes
+def test_segmentersAgree():
+    for line in getLines(None):
+        segs, chars = scan.segmentLine(line)
+        vcSegs, phonemeChars = scan.segmentLinePhonemes(line)
+        assert segs == scan.getLineSegments(vcSegs), line["line_text"]
+        assert chars == phonemeChars, line["line_text"]